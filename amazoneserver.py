@@ -1,69 +1,251 @@
-import errno
-import socket
-import sys
-import json
+import argparse
+import queue
+import signal
+import threading
 import time
 
-def listen():
+from dnscore import (DATAGRAM_MAX, FRAME_MAX, NOT_FOUND, REFUSED, STATS_FLAG, STATS_REPLY_FLAG, BinaryCodec,
+                     Histogram, Rate, RRTable, TCPListener, UDPConnection, deserialize, fit, split_batch)
+from ratelimit import RateLimiter
+from tablelog import TableLog
+
+# Kept on every query; each update is a few additions, cheap enough to leave on
+stats = {"queries": 0, "batches": 0, "not_found": 0, "invalid": 0, "dropped": 0, "refused": 0,
+         "tcp_queries": 0, "truncated": 0}
+query_rate = Rate()
+handle_latency = Histogram()
+started = time.monotonic()
+# Per-client token buckets, checked in the receive loop before anything is decoded (see main)
+limiter = RateLimiter(0)
+
+def answer_for(name, type_):
+    stats["queries"] += 1
+    query_rate.mark()
+    # Check RR table for record
+    record = rr_table.get_record(name, type_)
+    if record is None and type_.upper() != "CNAME":
+        # An alias answers for every type; the local server follows it to the target
+        record = rr_table.get_record(name, "CNAME")
+
+    if record is None:
+        stats["not_found"] += 1
+        return {
+            "name": name,
+            "type": type_,
+            "ttl": 0, # TTL doesn't matter for "not found"
+            "result": NOT_FOUND
+        }
+    # Use the data from the found record
+    return {
+        "name": record.name,
+        "type": record.type,
+        # Use a default TTL if the static record has 'None'
+        "ttl": 60 if record.ttl is None else record.ttl,
+        "result": record.result
+    }
+
+def handle_query(data, address, latency=0):
+    msg = deserialize(data)
+    # Answer in the same wire format the query came in
+    binary = BinaryCodec.is_binary(data)
+
+    if isinstance(msg, dict) and msg.get("flag") == STATS_FLAG:
+        send({"txid": msg.get("txid"), "flag": STATS_REPLY_FLAG, "stats": stats_snapshot()}, address)
+        return
+
+    # Validate the incoming JSON query: one "question", or a batch of "questions"
+    if (not isinstance(msg, dict) or msg.get("flag") != "0000" or "txid" not in msg
+            or ("question" not in msg and not isinstance(msg.get("questions"), list))):
+        stats["invalid"] += 1
+        print(f"Invalid query format recieved from {address}")
+        return
+
+    if isinstance(msg.get("questions"), list):
+        handle_batch(msg, address, latency)
+        return
+
+    # Get query details from the JSON
+    client_txid = msg.get("txid")
+    name, type_ = question_of(msg.get("question"))
+
+    if not name or not type_:
+        stats["invalid"] += 1
+        print(f"Invalid query (missing name/type) from {address}")
+        return
+
+    answer = answer_for(name, type_)
+
+    # Optional artificial delay, only for testing clients against a slow server
+    if latency > 0:
+        time.sleep(latency)
+
+    # Build the JSON response
+    response_msg = {
+        "txid": client_txid,
+        "flag": "0001",  # This is a response
+        "answer": answer
+    }
+
+    # Serialize the entire response dictionary and send it
+    send(response_msg, address, binary)
+
+    # Log the query (or display the RR table, depending on --log)
+    log_answer(address, answer)
+
+def question_of(question):
+    # (name, type) of a question, or (None, None) unless both are strings
+    if not isinstance(question, dict):
+        return None, None
+    name, type_ = question.get("name"), question.get("type")
+    if not isinstance(name, str) or not isinstance(type_, str):
+        return None, None
+    return name, type_
+
+def handle_batch(msg, address, latency=0):
+    # Answers go back in question order, echoing any per-question txid, in as many
+    # datagrams as BATCH_BUDGET needs; "first" is the position of a datagram's first answer
+    stats["batches"] += 1
+    answers = []
+    for question in msg["questions"]:
+        name, type_ = question_of(question)
+        if not name or not type_:
+            stats["invalid"] += 1
+            answers.append({"name": "", "type": "", "ttl": 0, "result": NOT_FOUND})
+            continue
+        answer = answer_for(name, type_)
+        if "txid" in question:
+            answer["txid"] = question["txid"]
+        answers.append(answer)
+
+    if latency > 0:
+        time.sleep(latency)
+
+    first = 0
+    for run in split_batch(answers):
+        response_msg = {"txid": msg["txid"], "flag": "0001", "first": first, "answers": run}
+        send(response_msg, address)
+        first += len(run)
+
+    for answer in answers:
+        log_answer(address, answer)
+
+def refuse(data, address):
+    # The cheap answer for a query that would wait too long: no lookup, no log line,
+    # just the question echoed back with REFUSED so the client need not time out
+    stats["refused"] += 1
+    msg = deserialize(data)
+    if not isinstance(msg, dict) or msg.get("flag") != "0000":
+        return
+    batch = isinstance(msg.get("questions"), list)
+    answers = []
+    for question in msg["questions"] if batch else [msg.get("question")]:
+        question = question if isinstance(question, dict) else {}
+        answer = {"name": question.get("name", ""), "type": question.get("type", ""), "ttl": 0, "result": REFUSED}
+        if "txid" in question:
+            answer["txid"] = question["txid"]
+        answers.append(answer)
+    if not batch:
+        response_msg = {"txid": msg.get("txid"), "flag": "0001", "answer": answers[0]}
+        send(response_msg, address, BinaryCodec.is_binary(data))
+        return
+    first = 0
+    for run in split_batch(answers):
+        send({"txid": msg.get("txid"), "flag": "0001", "first": first, "answers": run}, address)
+        first += len(run)
+
+def send(message, address, binary=False):
+    # A query that came over TCP is answered on its connection, where a reply can be as big
+    # as a frame; over UDP a response too big for a datagram goes out truncated instead,
+    # and the client asks again over TCP
+    stream = getattr(address, "stream", None)
+    wire, cut = fit(message, binary, DATAGRAM_MAX if stream is None else FRAME_MAX)
+    if cut:
+        stats["truncated"] += 1
+    if stream is None:
+        udp_connection.send_message(wire, address)
+        return
+    try:
+        stream.send_message(wire)
+    except OSError:
+        pass  # the client has hung up
+
+def handle_tcp(data, address, latency=0):
+    # Queries on a TCP connection are handled on that connection's own thread
+    stats["tcp_queries"] += 1
+    if not limiter.allow(address):
+        stats["dropped"] += 1
+        return
+    start = time.perf_counter()
+    handle_query(data, address, latency)
+    handle_latency.observe(time.perf_counter() - start)
+
+def log_answer(address, answer):
+    table_log.query(t=round(time.time(), 3), client=f"{address[0]}:{address[1]}", name=answer["name"],
+                    type=answer["type"], result=answer["result"], ttl=answer["ttl"])
+
+def stats_snapshot():
+    return {
+        "uptime_s": round(time.monotonic() - started, 1),
+        "qps_10s": query_rate.per_second(),
+        **stats,
+        "clients_tracked": len(limiter),
+        "log_dropped": table_log.dropped,
+        "records": len(rr_table.records),
+        "zone_records": sum(len(zone) for zone in rr_table.zones),
+        "handle_latency": handle_latency.summary(),
+    }
+
+def listen(latency=0):
     try:
         while True:
             # Wait for query
-            time.sleep(1)
             data, address = udp_connection.receive_message()
-            time.sleep(1)
-            
-            # Check RR table for record
-            msg = deserialize(data)
-
-            # Validate the incoming JSON query
-            if not isinstance(msg, dict) or msg.get("flag") != "0000" or "question" not in msg or "txid" not in msg:
-                print(f"Invalid query format recieved from {address}")
+            if not limiter.allow(address):
+                stats["dropped"] += 1
                 continue
+            start = time.perf_counter()
+            handle_query(data, address, latency)
+            handle_latency.observe(time.perf_counter() - start)
 
-            # Get query details from the JSON
-            client_txid = msg.get("txid")
-            question = msg.get("question", {})
-            name = question.get("name")
-            type_ = question.get("type")
+    except KeyboardInterrupt:
+        print("Keyboard interrupt received, exiting...")
+    finally:
+        # Close UDP socket
+        udp_connection.close()
 
-            if not name or not type_:
-                print(f"Invalid query (missing name/type) from {address}")
-                continue
-                
-            record = rr_table.get_record(name, type_)
-            time.sleep(1)
-            
-            # Build the JSON response
-            response_msg = {
-                "txid": client_txid,
-                "flag": "0001"  # This is a response
-            }
-
-            if record is None:
-                response_msg["answer"] = {
-                    "name": name,
-                    "type": type_,
-                    "ttl": 0, # TTL doesn't matter for "not found"
-                    "result": "Record not found"
-                }
-            else: 
-                # Use the data from the found record
-                response_msg["answer"] = {
-                    "name": record["name"],
-                    "type": record["type"],
-                    # Use a default TTL if the static record has 'None'
-                    "ttl": 60 if record["ttl"] is None else record["ttl"], 
-                    "result": record["result"]
-                }
-            
-            # Serialize the entire response dictionary and send it
-            response_str = serialize(response_msg)
-            udp_connection.send_message(response_str, address)
-            
-            # Display RR table
-            print(f"\nHandled query for {name} from {address}")
-            rr_table.display_table()
-            
+def listen_workers(workers, queue_size=1024, latency=0, shed_backlog=0):
+    # The receive loop only reads datagrams and queues them; the worker threads
+    # do the lookups and send the replies, so a slow query does not hold up the rest.
+    # When the queue is full the receive loop blocks and the kernel buffer absorbs the burst,
+    # unless shed_backlog is set: then queries arriving while that many are queued are refused.
+    requests = queue.Queue(maxsize=queue_size)
+
+    def work():
+        while True:
+            data, address = requests.get()
+            try:
+                start = time.perf_counter()
+                handle_query(data, address, latency)
+                handle_latency.observe(time.perf_counter() - start)
+            except OSError as e:
+                print(f"Socket error while replying to {address}: {e}")
+            except Exception as e:
+                # a query the parser didn't expect must not take the worker down with it
+                stats["invalid"] += 1
+                print(f"Error handling query from {address}: {e!r}")
+
+    for i in range(workers):
+        threading.Thread(target=work, name=f"amazone-worker-{i}", daemon=True).start()
+
+    try:
+        while True:
+            data, address = udp_connection.receive_message()
+            if not limiter.allow(address):
+                stats["dropped"] += 1
+            elif 0 < shed_backlog <= requests.qsize():
+                refuse(data, address)
+            else:
+                requests.put((data, address))
     except KeyboardInterrupt:
         print("Keyboard interrupt received, exiting...")
     finally:
@@ -71,145 +253,51 @@ def listen():
         udp_connection.close()
 
 def main():
+    parser = argparse.ArgumentParser(description="Amazone authoritative DNS server")
+    parser.add_argument("--port", type=int, default=22000, help="UDP and TCP port to listen on")
+    parser.add_argument("--workers", type=int, default=0, help="number of worker threads (0 = handle queries inline)")
+    parser.add_argument("--queue-size", type=int, default=1024, help="bounded request queue size for worker mode")
+    parser.add_argument("--rate-limit", type=float, default=0, help="queries per second allowed per client address (0 = unlimited)")
+    parser.add_argument("--rate-burst", type=float, default=None, help="queries a client may send at once (default: one second's worth)")
+    parser.add_argument("--shed-backlog", type=int, default=0,
+                        help="worker mode: refuse queries while this many are queued (0 = never)")
+    parser.add_argument("--latency", type=float, default=0, help="seconds of artificial delay per query, for testing")
+    parser.add_argument("--log", choices=TableLog.MODES, default="table",
+                        help="per query: dump the whole table, print one JSON line, or nothing (SIGUSR1 always dumps)")
+    parser.add_argument("--dump-interval", type=float, default=0.0, help="least seconds between two table dumps")
+    parser.add_argument("--zone", metavar="PATH", action="append", default=[],
+                        help="also serve the records in this zone file (repeatable)")
+    args = parser.parse_args()
+
     # Add initial records
     # These can be found in the test cases diagram
-    global rr_table, udp_connection
+    global rr_table, udp_connection, table_log, limiter
     rr_table = RRTable()
+    # Query output and table dumps are written from a background thread
+    table_log = TableLog(rr_table.display_table, args.log, args.dump_interval)
+    signal.signal(signal.SIGUSR1, lambda *_: table_log.dump())
     rr_table.add_record("shop.amazone.com", "A", "3.33.147.88", None, True)
     rr_table.add_record("cloud.amazone.com", "A", "15.197.140.28", None, True)
+    rr_table.add_record("www.amazone.com", "CNAME", "shop.amazone.com", None, True)
+    for path in args.zone:
+        print(f"Loaded zone {path}: {rr_table.load_zone(path)} records")
+
+    limiter = RateLimiter(args.rate_limit, args.rate_burst)
 
-    amazone_dns_address = ("127.0.0.1", 22000)
+    amazone_dns_address = ("127.0.0.1", args.port)
     # Bind address to UDP socket
     udp_connection = UDPConnection()
     udp_connection.bind(amazone_dns_address)
-    listen()
-
-
-def serialize(message_dict):
-    return json.dumps(message_dict)
-
-
-def deserialize(data):
+    # TCP on the same port, for answers too big for a datagram
+    tcp_listener = TCPListener(amazone_dns_address)
+    tcp_listener.serve(lambda data, address: handle_tcp(data, address, args.latency))
     try:
-        return json.loads(data)
-    except json.JSONDecodeError:
-        return None # Return None if JSON is invalid
-
-
-class RRTable:
-    def __init__(self):
-        self.records = []
-        self.record_number = 0
-
-    def add_record(self, name, type_, result, ttl, static):
-        self.records.append({
-            "record_number" : self.record_number,
-            "name": name, 
-            "type": type_,
-            "result": result,
-            "ttl": ttl,
-            "static": 1 if static else 0 
-        })
-        self.record_number += 1
-        pass
-
-    def get_record(self, name, type_):
-        for record in self.records:
-            if record["name"] == name and record["type"] == type_:
-                return record
-        return None
-
-    def display_table(self): #, name, type_
-        print("record_number, name, type, result, ttl, static")
-        for r in self.records:
-            print(f'{r["record_number"]}, {r["name"]},{r["type"]}, {r["result"]}, {r["ttl"]}, {r["static"]}')
-            print("-" * 50)
-        # Display the table in the following format (include the column names):
-        # record_number,name,type,result,ttl,static
-        pass
-
-
-class DNSTypes:
-    """
-    A class to manage DNS query types and their corresponding codes.
-
-    Examples:
-    >>> DNSTypes.get_type_code('A')
-    8
-    >>> DNSTypes.get_type_name(0b0100)
-    'AAAA'
-    """
-
-    name_to_code = {
-        "A": 0b1000,
-        "AAAA": 0b0100,
-        "CNAME": 0b0010,
-        "NS": 0b0001,
-    }
-
-    code_to_name = {code: name for name, code in name_to_code.items()}
-
-    @staticmethod
-    def get_type_code(type_name: str):
-        """Gets the code for the given DNS query type name, or None"""
-        return DNSTypes.name_to_code.get(type_name, None)
-
-    @staticmethod
-    def get_type_name(type_code: int):
-        """Gets the DNS query type name for the given code, or None"""
-        return DNSTypes.code_to_name.get(type_code, None)
-
-
-class UDPConnection:
-    """A class to handle UDP socket communication, capable of acting as both a client and a server."""
-
-    def __init__(self, timeout: int = 1):
-        """Initializes the UDPConnection instance with a timeout. Defaults to 1."""
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.settimeout(timeout)
-        self.is_bound = False
-
-    def send_message(self, message: str, address: tuple[str, int]):
-        """Sends a message to the specified address."""
-        self.socket.sendto(message.encode(), address)
-
-    def receive_message(self):
-        """
-        Receives a message from the socket.
-
-        Returns:
-            tuple (data, address): The received message and the address it came from.
-
-        Raises:
-            KeyboardInterrupt: If the program is interrupted manually.
-        """
-        while True:
-            try:
-                data, address = self.socket.recvfrom(4096)
-                return data.decode(), address
-            except socket.timeout:
-                continue
-            except OSError as e:
-                if e.errno == errno.ECONNRESET:
-                    print("Error: Unable to reach the other socket. It might not be up and running.")
-                else:
-                    print(f"Socket error: {e}")
-                self.close()
-                sys.exit(1)
-            except KeyboardInterrupt:
-                raise
-
-    def bind(self, address: tuple[str, int]):
-        """Binds the socket to the given address. This means it will be a server."""
-        if self.is_bound:
-            print(f"Socket is already bound to address: {self.socket.getsockname()}")
-            return
-        self.socket.bind(address)
-        self.is_bound = True
-
-    def close(self):
-        """Closes the UDP socket."""
-        self.socket.close()
+        if args.workers > 0:
+            listen_workers(args.workers, args.queue_size, args.latency, args.shed_backlog)
+        else:
+            listen(args.latency)
+    finally:
+        tcp_listener.close()
 
 
 if __name__ == "__main__":
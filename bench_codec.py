@@ -0,0 +1,49 @@
+import argparse
+import json
+import time
+
+from dnscore import BinaryCodec, DNSTypes
+
+# Encode/decode throughput and datagram size of the binary codec vs. the JSON path.
+
+QUERY = {"txid": 123456, "flag": "0000", "question": {"name": "shop.amazone.com", "type": "A"}}
+ANSWER = {"txid": 123456, "flag": "0001",
+          "answer": {"name": "shop.amazone.com", "type": "A", "ttl": 60, "result": "3.33.147.88"}}
+NEGATIVE = {"txid": 123456, "flag": "0001",
+            "answer": {"name": "typo.amazone.com", "type": "A", "ttl": 30, "result": "Record not found"}}
+
+
+def json_encode(message):
+    # same as dnscore.serialize + UDPConnection.send_message
+    return json.dumps(message, separators=(",", ":")).encode()
+
+
+def json_decode(data):
+    # same as UDPConnection.receive_message + deserialize
+    return json.loads(data.decode())
+
+
+def rate(fn, arg, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        fn(arg)
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Binary vs JSON wire codec benchmark")
+    parser.add_argument("-n", type=int, default=200_000, help="iterations per measurement")
+    args = parser.parse_args()
+
+    codec = BinaryCodec(DNSTypes.name_to_code)
+    print("message,format,bytes,encode_per_s,decode_per_s")
+    for label, message in (("query", QUERY), ("answer", ANSWER), ("negative", NEGATIVE)):
+        packed = codec.encode(message)
+        text = json_encode(message)
+        assert codec.decode(packed) == json_decode(text) == message
+        print(f"{label},json,{len(text)},{rate(json_encode, message, args.n):.0f},{rate(json_decode, text, args.n):.0f}")
+        print(f"{label},binary,{len(packed)},{rate(codec.encode, message, args.n):.0f},{rate(codec.decode, packed, args.n):.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+from dnscore import BinaryCodec, DNSTypes
+
+# End-to-end load generator for client -> localserver -> amazoneserver.
+#
+# Starts both servers on spare ports (or targets running ones with --no-spawn),
+# drives the local server with --concurrency closed-loop senders, and reports
+# qps and p50/p99/p999 latency. Each run is appended as one JSON line to --out
+# so results can be compared across commits.
+#
+# The workload is either generated (--queries, --hit-ratio, --mix) or replayed
+# from a JSONL file (--replay) whose lines look like
+#     {"name": "shop.amazone.com", "type": "A"}
+# --record writes the generated workload in that same format.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CODEC = BinaryCodec(DNSTypes.name_to_code)
+
+# names the amazone server has records for; queried as the "hot" set
+HOT_NAMES = ["shop.amazone.com", "cloud.amazone.com"]
+
+
+def parse_mix(text):
+    """'A=0.8,NS=0.2' -> ([types], [weights])"""
+    types, weights = [], []
+    for part in text.split(","):
+        rtype, _, weight = part.partition("=")
+        types.append(rtype.strip().upper())
+        weights.append(float(weight or 1))
+    return types, weights
+
+
+def generate_workload(n, hit_ratio, mix, seed):
+    rng = random.Random(seed)
+    types, weights = parse_mix(mix)
+    workload = []
+    for i in range(n):
+        if rng.random() < hit_ratio:
+            workload.append({"name": rng.choice(HOT_NAMES), "type": "A"})
+        else:
+            # unique names always miss the local cache and go upstream
+            workload.append({"name": f"cold{seed}-{i}.amazone.com", "type": rng.choices(types, weights)[0]})
+    return workload
+
+
+def load_workload(path):
+    workload = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            question = item.get("question", item)
+            if "name" in question:
+                workload.append({"name": question["name"], "type": question.get("type", "A")})
+    return workload
+
+
+class LoadClient(asyncio.DatagramProtocol):
+    def __init__(self, binary):
+        self.binary = binary
+        self.transport = None
+        self.waiting = {}  # txid -> future
+        self.next_txid = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        msg = CODEC.decode(data) if BinaryCodec.is_binary(data) else json.loads(data)
+        fut = self.waiting.pop(msg.get("txid"), None)
+        if fut is not None and not fut.done():
+            fut.set_result(msg)
+
+    async def query(self, target, name, rtype, timeout):
+        txid = self.next_txid
+        self.next_txid = (txid + 1) & 0xFFFFFFFF
+        msg = {"txid": txid, "flag": "0000", "question": {"name": name, "type": rtype}}
+        wire = CODEC.encode(msg) if self.binary else None
+        fut = asyncio.get_running_loop().create_future()
+        self.waiting[txid] = fut
+        self.transport.sendto(wire or json.dumps(msg, separators=(",", ":")).encode(), target)
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            self.waiting.pop(txid, None)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+async def run_load(target, workload, concurrency, timeout, binary):
+    loop = asyncio.get_running_loop()
+    transport, client = await loop.create_datagram_endpoint(lambda: LoadClient(binary), local_addr=("127.0.0.1", 0))
+    latencies, counts = [], {"ok": 0, "not_found": 0, "servfail": 0, "refused": 0, "timeouts": 0}
+    items = iter(workload)
+
+    async def sender():
+        for item in items:
+            start = time.perf_counter()
+            try:
+                resp = await client.query(target, item["name"], item["type"], timeout)
+            except asyncio.TimeoutError:
+                counts["timeouts"] += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+            result = resp.get("answer", {}).get("result")
+            if result == "Record not found":
+                counts["not_found"] += 1
+            elif result == "Server failure":
+                counts["servfail"] += 1
+            elif result == "Query refused":
+                counts["refused"] += 1
+            else:
+                counts["ok"] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(sender() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    transport.close()
+    return elapsed, sorted(latencies), counts
+
+
+def spawn_servers(args):
+    quiet = {"stdout": subprocess.DEVNULL, "stderr": subprocess.DEVNULL, "cwd": HERE}
+    amazone = subprocess.Popen([sys.executable, "amazoneserver.py", "--port", str(args.upstream_port),
+                                *args.amazone_args.split()], **quiet)
+    local = subprocess.Popen([sys.executable, "localserver.py", "--port", str(args.port),
+                              "--upstream-port", str(args.upstream_port), *args.local_args.split()], **quiet)
+    time.sleep(args.startup_wait)
+    return [local, amazone]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end resolver benchmark")
+    parser.add_argument("--port", type=int, default=31000, help="local server port")
+    parser.add_argument("--upstream-port", type=int, default=32000, help="amazone server port")
+    parser.add_argument("--no-spawn", action="store_true", help="target servers that are already running")
+    parser.add_argument("--local-args", default="", help="extra arguments for localserver.py, e.g. --local-args=\"--asyncio\"")
+    parser.add_argument("--amazone-args", default="", help="extra arguments for amazoneserver.py")
+    parser.add_argument("--startup-wait", type=float, default=1.0, help="seconds to wait for spawned servers")
+    parser.add_argument("--concurrency", type=int, default=32, help="queries in flight")
+    parser.add_argument("--queries", type=int, default=20_000, help="generated workload size")
+    parser.add_argument("--hit-ratio", type=float, default=0.9, help="fraction of queries for already-cached names")
+    parser.add_argument("--mix", default="A=1", help="type mix for cold queries, e.g. A=0.8,AAAA=0.1,NS=0.1")
+    parser.add_argument("--seed", type=int, default=None, help="workload seed (default: time-based)")
+    parser.add_argument("--replay", help="JSONL workload to replay instead of generating one")
+    parser.add_argument("--record", help="write the workload used to this JSONL file")
+    parser.add_argument("--timeout", type=float, default=2.0, help="per-query timeout in seconds")
+    parser.add_argument("--wire", choices=("json", "binary"), default="json")
+    parser.add_argument("--label", default="", help="free-form tag stored with the result")
+    parser.add_argument("--out", default=os.path.join(HERE, "bench_output.txt"), help="append results here as JSON lines")
+    args = parser.parse_args()
+
+    seed = args.seed if args.seed is not None else int(time.time())
+    workload = load_workload(args.replay) if args.replay else generate_workload(args.queries, args.hit_ratio, args.mix, seed)
+    if args.record:
+        with open(args.record, "w") as f:
+            f.writelines(json.dumps(item) + "\n" for item in workload)
+
+    procs = [] if args.no_spawn else spawn_servers(args)
+    target = ("127.0.0.1", args.port)
+    try:
+        # warm the hot names so they are cache hits during the run
+        asyncio.run(run_load(target, [{"name": n, "type": "A"} for n in HOT_NAMES], 1, args.timeout, args.wire == "binary"))
+        elapsed, latencies, counts = asyncio.run(
+            run_load(target, workload, args.concurrency, args.timeout, args.wire == "binary"))
+    finally:
+        for p in procs:
+            p.terminate()
+            p.wait()
+
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    result = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "label": args.label,
+        "queries": len(workload),
+        "concurrency": args.concurrency,
+        "hit_ratio": None if args.replay else args.hit_ratio,
+        "replay": args.replay,
+        "seed": None if args.replay else seed,
+        "wire": args.wire,
+        "local_args": args.local_args,
+        "amazone_args": args.amazone_args,
+        "elapsed_s": round(elapsed, 3),
+        "qps": round(len(latencies) / elapsed, 1) if elapsed else 0,
+        "p50_ms": ms(percentile(latencies, 0.50)),
+        "p99_ms": ms(percentile(latencies, 0.99)),
+        "p999_ms": ms(percentile(latencies, 0.999)),
+        **counts,
+    }
+    print(json.dumps(result, indent=2))
+    with open(args.out, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import argparse
+import random
+import time
+
+from dnscore import RRTable
+
+# Lookup cost of RRTable.get_record as the table grows.
+# With the (name, type) index the ns/lookup column should stay flat.
+
+SIZES = (100, 1_000, 10_000, 100_000)
+
+
+def build_table(size):
+    rr = RRTable()
+    for i in range(size):
+        # static so the TTL thread never touches them while we measure
+        rr.add_record(f"host{i}.bench.test", "A", f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", None, True)
+    return rr
+
+
+def time_lookups(rr, names, rtype):
+    start = time.perf_counter()
+    for name in names:
+        rr.get_record(name, rtype)
+    return (time.perf_counter() - start) / len(names) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RRTable lookup benchmark")
+    parser.add_argument("--lookups", type=int, default=100_000, help="lookups per table size")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    args = parser.parse_args()
+
+    print("size,hit_ns_per_lookup,miss_ns_per_lookup")
+    for size in args.sizes:
+        rr = build_table(size)
+        # mixed-case names so normalization is part of what we measure
+        hits = [f"HOST{random.randrange(size)}.bench.test" for _ in range(args.lookups)]
+        misses = [f"nohost{i}.bench.test" for i in range(args.lookups)]
+        hit_ns = time_lookups(rr, hits, "a")
+        miss_ns = time_lookups(rr, misses, "A")
+        print(f"{size},{hit_ns:.0f},{miss_ns:.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,73 +1,60 @@
-import errno
+import argparse
 import json
 import socket
-import sys
-import threading
 import time
 
+from dnscore import (DATAGRAM_MAX, NOT_FOUND, REFUSED, SERVFAIL, STATS_FLAG, STATS_REPLY_FLAG, BinaryCodec, DNSTypes,
+                     RRTable, TCPPool, UDPConnection, deserialize, format_stats, serialize, split_batch)
 
-def handle_request():
-    # Check RR table for record
-    global rr_table, udp_conn, next_txid, current_hostname, current_query_code
 
-    hostname = current_hostname
-    qtype_name = DNSTypes.get_type_name(current_query_code)
+LOCAL_DNS_ADDRESS = ("127.0.0.1", 21000)
 
-    cached = rr_table.get_record(hostname, qtype_name)
-    if cached is not None:
-        rr_table.display_table()
-        return
-
-    # If not found, ask the local DNS server, then save the record if valid
-    local_dns_address = ("127.0.0.1", 21000)
 
-    # The format of the DNS query and response is in the project description
-    txid = next_txid & 0xFFFFFFFF
-    next_txid = (txid + 1) & 0xFFFFFFFF
+def handle_request(resolver: "Resolver", hostname: str, qtype_name: str, log_mode: str = "table"):
+    # Check RR table for record; if not found, ask the local DNS server,
+    # then save the record if valid (the resolver caches into its rr_table)
+    answer = resolver.resolve(hostname, qtype_name)
 
-    query_msg = {
-        "txid": txid,
-        "flag": "0000",  # query
-        "question": {"name": hostname, "type": qtype_name},
-    }
+    # Display RR table, or just this answer as one JSON line
+    if log_mode == "table":
+        resolver.rr_table.display_table()
+    elif log_mode == "query":
+        print(json.dumps(answer or {"name": hostname, "type": qtype_name, "result": None}))
 
-    udp_conn.send_message(serialize(query_msg), local_dns_address)
 
+def fetch_stats(server: tuple[str, int] = LOCAL_DNS_ADDRESS, timeout: float = 3.0):
+    """Asks a server (local or amazone) for its counters; returns the stats dict, or None on timeout."""
+    conn = UDPConnection(timeout=timeout)
     try:
-        wire, _addr = udp_conn.receive_message()
-        resp = deserialize(wire)
-
-        # basic validation
-        if not isinstance(resp, dict) or resp.get("flag") != "0001" or resp.get("txid") != txid:
-            rr_table.display_table()
-            return
-
-        ans = resp.get("answer", {})
-        result = ans.get("result", "Record not found")
-        ttl = ans.get("ttl", 0)
-        name = ans.get("name", hostname)
-        rtype = ans.get("type", qtype_name)
-
-        if result != "Record not found":
-            rr_table.add_record(name=name, rtype=rtype, result=result, ttl=int(ttl), is_static=False)
-
-    except socket.timeout:
-        # no response; just fall through to display
-        pass
-
-    # Display RR table
-    rr_table.display_table()
+        conn.send_message(serialize({"txid": 0, "flag": STATS_FLAG}), server)
+        data, _addr = conn.socket.recvfrom(65535)
+    except (socket.timeout, ConnectionResetError):
+        return None
+    finally:
+        conn.close()
+    resp = deserialize(data.decode(errors="replace"))
+    if not isinstance(resp, dict) or resp.get("flag") != STATS_REPLY_FLAG:
+        return None
+    return resp.get("stats")
 
 
 def main():
+    parser = argparse.ArgumentParser(description="DNS client")
+    parser.add_argument("--wire", choices=("json", "binary"), default="json", help="wire format for queries")
+    parser.add_argument("--log", choices=("table", "query", "off"), default="table",
+                        help="after each request: show the whole RR table, one JSON line for the answer, or nothing")
+    parser.add_argument("--stats", type=int, nargs="?", const=LOCAL_DNS_ADDRESS[1], metavar="PORT",
+                        help="print the counters of the server on PORT (default: the local server) and exit")
+    args = parser.parse_args()
+
+    if args.stats is not None:
+        stats = fetch_stats((LOCAL_DNS_ADDRESS[0], args.stats))
+        print("No reply from the server" if stats is None else format_stats(stats))
+        return
+
+    resolver = None
     try:
-        # init globals used by handle_request()
-        global rr_table, udp_conn, next_txid, current_hostname, current_query_code
-        rr_table = RRTable()
-        udp_conn = UDPConnection(timeout=3)
-        next_txid = 0
-        current_hostname = ""
-        current_query_code = DNSTypes.get_type_code("A")
+        resolver = Resolver(timeout=3, binary=args.wire == "binary", rr_table=RRTable())
 
         while True:
             input_value = input("Enter the hostname (or type 'quit' to exit) ")
@@ -87,187 +74,438 @@ def main():
                 if qc is not None:
                     query_code = qc
 
-            current_hostname = hostname
-            current_query_code = query_code
-
-            handle_request()
+            handle_request(resolver, hostname, DNSTypes.get_type_name(query_code), args.log)
 
     except KeyboardInterrupt:
         print("Keyboard interrupt received, exiting...")
     finally:
         # Close UDP socket
-        try:
-            udp_conn.close()
-        except Exception:
-            pass
+        if resolver is not None:
+            resolver.close()
 
 
-def serialize(message=None):
-    # Consider creating a serialize function
-    # This can help prepare data to send through the socket
-    if isinstance(message, str):
-        return message
-    return json.dumps(message, separators=(",", ":"))
+class ResolverBase:
+    """Query building, reply checking and caching shared by Resolver and AsyncResolver."""
 
+    def __init__(self, server: tuple[str, int] = LOCAL_DNS_ADDRESS, timeout: float = 3.0,
+                 binary: bool = False, rr_table: "RRTable | None" = None):
+        """
+        server: the local DNS server to query.
+        timeout: seconds to wait for each query's reply; unanswered queries resolve to None.
+        binary: send queries in the binary wire format instead of JSON.
+        rr_table: optional cache consulted before querying and filled with the answers.
+        """
+        self.server = server
+        self.timeout = timeout
+        self.binary = binary
+        self.rr_table = rr_table
+        self.next_txid = 0
+        # for answers too big for a datagram: asked for again over a connection kept open between them
+        self.tcp = TCPPool(timeout)
+
+    def _query(self, name: str, rtype: str):
+        """Returns (txid, wire) for a new query."""
+        txid = self.next_txid
+        self.next_txid = (txid + 1) & 0xFFFFFFFF
+        query_msg = {
+            "txid": txid,
+            "flag": "0000",  # query
+            "question": {"name": name, "type": rtype},
+        }
+        wire = serialize(query_msg, self.binary)
+        return txid, wire.encode() if isinstance(wire, str) else wire
+
+    def _batch_queries(self, questions):
+        """Returns [(txid, wire, indices)] asking all of questions, split so each datagram fits the batch budget."""
+        indexed = [({"name": name, "type": rtype}, i) for i, (name, rtype) in enumerate(questions)]
+        batches = []
+        for run in split_batch([q for q, _ in indexed]):
+            txid = self.next_txid
+            self.next_txid = (txid + 1) & 0xFFFFFFFF
+            wire = serialize({"txid": txid, "flag": "0000", "questions": run})
+            batches.append((txid, wire.encode(), [i for _, i in indexed[:len(run)]]))
+            indexed = indexed[len(run):]
+        return batches
+
+    def _cached(self, name: str, rtype: str):
+        """Returns the cached answer for (name, type), or None."""
+        if self.rr_table is None:
+            return None
+        rec = self.rr_table.get_record(name, rtype)
+        if rec is None:
+            return None
+        return {"name": rec.name, "type": rec.type, "ttl": rec.ttl, "result": rec.result}
 
-def deserialize(wire=None):
-    # Consider creating a deserialize function
-    # This can help prepare data that is received from the socket
-    try:
-        return json.loads(wire)
-    except (json.JSONDecodeError, TypeError):
-        return wire
-
-
-class RRTable:
-    def __init__(self):
-        # self.records = ?
-        self.records = []
-        self.record_number = 0
-
-        # Start the background thread
-        self.lock = threading.Lock()
-        self.thread = threading.Thread(target=self.__decrement_ttl, daemon=True)
-        self.thread.start()
-
-    def add_record(self, name: str, rtype: str, result: str, ttl: int, is_static: bool):
-        with self.lock:
-            rec = {
-                "id": self.record_number,
-                "name": name,
-                "type": rtype,
-                "result": result,
-                "ttl": None if is_static else max(0, int(ttl)),
-                "static": 1 if is_static else 0,
-            }
-            self.records.append(rec)
-            self.record_number += 1
-
-    def get_record(self, name: str, rtype: str):
-        with self.lock:
-            name_lc = name.lower()
-            for rec in self.records:
-                if rec["name"].lower() == name_lc and rec["type"].upper() == rtype.upper():
-                    if rec["static"] == 1:
-                        return rec
-                    if isinstance(rec["ttl"], int) and rec["ttl"] > 0:
-                        return rec
+    @staticmethod
+    def _parse_reply(data):
+        """
+        Returns (txid, answer) for a valid response datagram, or None.
+
+        For one part of a batch reply the answer is {"first": position of its first answer, "answers": [...]},
+        and for a reply that was too big to send it is {"tc": 1}: the query has to be sent again over TCP.
+        """
+        if not isinstance(data, str):
+            data = data if BinaryCodec.is_binary(data) else data.decode(errors="replace")
+        resp = deserialize(data)
+        if not isinstance(resp, dict) or resp.get("flag") != "0001" or not isinstance(resp.get("txid"), int):
             return None
+        if resp.get("tc"):
+            return resp["txid"], {"tc": 1}
+        if isinstance(resp.get("answers"), list) and isinstance(resp.get("first", 0), int):
+            return resp["txid"], {"first": resp.get("first", 0), "answers": resp["answers"]}
+        ans = resp.get("answer")
+        if isinstance(ans, dict) and isinstance(resp.get("chain"), list):
+            # The CNAME links the local server followed to get this answer
+            ans = {**ans, "chain": [link for link in resp["chain"] if isinstance(link, dict)]}
+        return (resp["txid"], ans) if isinstance(ans, dict) else None
+
+    def _accept(self, name: str, rtype: str, ans: dict):
+        """Fills in missing answer fields and caches the answer, and any CNAME links in its chain, in rr_table."""
+        chain = ans.get("chain")
+        ans = {
+            "name": ans.get("name", name),
+            "type": ans.get("type", rtype),
+            "ttl": ans.get("ttl", 0),
+            "result": ans.get("result", NOT_FOUND),
+        }
+        if chain:
+            ans["chain"] = chain
+        if self.rr_table is not None:
+            for link in chain or ():
+                if {"name", "ttl", "result"} <= link.keys() and int(link["ttl"]) > 0:
+                    self.rr_table.add_record(link["name"], "CNAME", link["result"], int(link["ttl"]), False)
+            ttl = int(ans["ttl"])
+            # "Server failure" means the local server gave up on upstream and "Query refused" that
+            # it was too busy to ask; nothing to cache
+            if ans["result"] == NOT_FOUND:
+                # Negative answer: cache it for as long as the local server says (0 = don't)
+                if ttl > 0:
+                    self.rr_table.add_record(ans["name"], ans["type"], ans["result"], ttl, False, is_negative=True)
+            elif ans["result"] not in (SERVFAIL, REFUSED):
+                self.rr_table.add_record(ans["name"], ans["type"], ans["result"], ttl, False)
+        return ans
 
-    def display_table(self):
-        with self.lock:
-            # Display the table in the following format (include the column names):
-            # record_number,name,type,result,ttl,static
-            print("record_number,name,type,result,ttl,static")
-            for rec in self.records:
-                ttl_field = "None" if rec["ttl"] is None else rec["ttl"]
-                print(f'{rec["id"]},{rec["name"]},{rec["type"]},{rec["result"]},{ttl_field},{rec["static"]}')
+    @staticmethod
+    def _questions(names, rtype):
+        """Accepts hostnames or (hostname, type) pairs."""
+        return [(n, rtype) if isinstance(n, str) else tuple(n) for n in names]
+
+    def _over_tcp(self, txid: int, wire: bytes):
+        """Sends a query again over TCP after a truncated reply; returns its answer, or None. Blocks."""
+        answer = []
+
+        def take(data):
+            parsed = self._parse_reply(data)
+            if parsed is None or parsed[0] != txid:
+                return False
+            answer.append(parsed[1])
+            return True
+
+        if not self.tcp.exchange(wire, self.server, take) or answer[0].get("tc"):
+            return None
+        return answer[0]
 
-    def __decrement_ttl(self):
-        while True:
-            with self.lock:
-                # Decrement ttl
-                for rec in self.records:
-                    if rec["static"] == 0 and isinstance(rec["ttl"], int) and rec["ttl"] > 0:
-                        rec["ttl"] -= 1
-                self.__remove_expired_records()
-            time.sleep(1)
-
-    def __remove_expired_records(self):
-        # This method is only called within a locked context
-
-        # Remove expired records
-        self.records = [
-            rec for rec in self.records
-            if rec["static"] == 1 or (isinstance(rec["ttl"], int) and rec["ttl"] > 0)
-        ]
-        # Update record numbers
-        for idx, rec in enumerate(self.records):
-            rec["id"] = idx
-        self.record_number = len(self.records)
-
-
-class DNSTypes:
+    def _batch_over_tcp(self, txid: int, wire: bytes, size: int):
+        """Sends a batch query again over TCP; returns its answers by position, None where missing. Blocks."""
+        received = [None] * size
+
+        def take(data):
+            parsed = self._parse_reply(data)
+            if parsed is None or parsed[0] != txid:
+                return False
+            part = parsed[1]
+            if "answers" not in part:
+                return True  # too big even for TCP: give up
+            for pos, ans in enumerate(part["answers"], part["first"]):
+                if 0 <= pos < size and isinstance(ans, dict):
+                    received[pos] = ans
+            return None not in received
+
+        self.tcp.exchange(wire, self.server, take)
+        return received
+
+
+class Resolver(ResolverBase):
     """
-    A class to manage DNS query types and their corresponding codes.
+    Resolves names through the local DNS server, keeping many queries in flight on one socket.
+
+    Replies are matched to queries by txid, so they may arrive in any order, and each query
+    has its own deadline. Answers are dicts like {"name", "type", "ttl", "result"}, or None
+    when no reply arrived in time.
 
-    Examples:
-    >>> DNSTypes.get_type_code('A')
-    8
-    >>> DNSTypes.get_type_name(0b0100)
-    'AAAA'
+    Example:
+        resolver = Resolver()
+        answers = resolver.resolve_many(["shop.amazone.com", ("amazone.com", "NS")])
     """
 
-    name_to_code = {
-        "A": 0b1000,
-        "AAAA": 0b0100,
-        "CNAME": 0b0010,
-        "NS": 0b0001,
-    }
+    def __init__(self, *args, window: int = 256, **kwargs):
+        """window: most queries in flight at once during resolve_many()."""
+        super().__init__(*args, **kwargs)
+        self.window = window
+        self.conn = UDPConnection(timeout=self.timeout)
+
+    def resolve(self, name: str, rtype: str = "A"):
+        """Resolves one name; returns its answer or None on timeout."""
+        return self.resolve_many([(name, rtype)])[0]
+
+    def resolve_many(self, names, rtype: str = "A"):
+        """Resolves hostnames or (hostname, type) pairs; returns answers in the same order."""
+        questions = self._questions(names, rtype)
+        answers = [None] * len(questions)
+        pending = iter(enumerate(questions))
+        # txid -> (index, deadline); insertion order is send order, so also deadline order
+        inflight = {}
+        # indices whose reply was truncated, asked again over TCP once the UDP loop is done,
+        # so a slow TCP exchange can't run other queries past their deadlines
+        truncated = []
+        sock = self.conn.socket
+
+        def fill():
+            for i, (name, qtype) in pending:
+                cached = self._cached(name, qtype)
+                if cached is not None:
+                    answers[i] = cached
+                    continue
+                txid, wire = self._query(name, qtype)
+                sock.sendto(wire, self.server)
+                inflight[txid] = (i, time.monotonic() + self.timeout)
+                if len(inflight) >= self.window:
+                    return
+
+        fill()
+        while inflight:
+            now = time.monotonic()
+            for txid, (i, deadline) in list(inflight.items()):
+                if deadline > now:
+                    break
+                del inflight[txid]  # timed out, answer stays None
+            fill()
+            if not inflight:
+                break
+            sock.settimeout(max(0.0, next(iter(inflight.values()))[1] - now))
+            try:
+                data, _addr = sock.recvfrom(DATAGRAM_MAX)
+            except socket.timeout:
+                continue
+            except ConnectionResetError:
+                # Nothing listening on the server port; the queries will time out
+                continue
+            parsed = self._parse_reply(data)
+            if parsed is None or parsed[0] not in inflight:
+                continue
+            i, _deadline = inflight.pop(parsed[0])
+            if parsed[1].get("tc"):
+                truncated.append(i)  # too big for a datagram
+            else:
+                answers[i] = self._accept(*questions[i], parsed[1])
+            fill()
+        for i in truncated:
+            ans = self._over_tcp(*self._query(*questions[i]))
+            if ans is not None:
+                answers[i] = self._accept(*questions[i], ans)
+        return answers
+
+    def resolve_batch(self, names, rtype: str = "A"):
+        """
+        Like resolve_many(), but the names the cache can't answer are sent as multi-question
+        queries: one datagram per batch-budget's worth of questions instead of one per name.
+        """
+        questions = self._questions(names, rtype)
+        answers = [self._cached(name, qtype) for name, qtype in questions]
+        missing = [i for i, ans in enumerate(answers) if ans is None]
+        # txid -> indices into questions, in the order the server answers them
+        inflight = {}
+        wires = {}
+        sock = self.conn.socket
+        for txid, wire, indices in self._batch_queries([questions[i] for i in missing]):
+            sock.sendto(wire, self.server)
+            inflight[txid] = [missing[j] for j in indices]
+            wires[txid] = wire
+        remaining = {txid: len(indices) for txid, indices in inflight.items()}
+        # batches with a truncated part, fetched again over TCP after the UDP loop (see resolve_many)
+        truncated = []
+
+        deadline = time.monotonic() + self.timeout
+        while remaining:
+            now = time.monotonic()
+            if now >= deadline:
+                break  # whatever is still missing stays None
+            sock.settimeout(deadline - now)
+            try:
+                data, _addr = sock.recvfrom(DATAGRAM_MAX)
+            except socket.timeout:
+                break
+            except ConnectionResetError:
+                continue
+            parsed = self._parse_reply(data)
+            if parsed is None or parsed[0] not in remaining:
+                continue
+            txid, part = parsed
+            if part.get("tc"):
+                # A part too big for a datagram: the whole batch is asked again over TCP
+                truncated.append(txid)
+                del remaining[txid]
+                continue
+            if "answers" not in part:
+                continue
+            indices = inflight[txid]
+            for pos, ans in enumerate(part["answers"], part["first"]):
+                if 0 <= pos < len(indices) and isinstance(ans, dict) and answers[indices[pos]] is None:
+                    answers[indices[pos]] = self._accept(*questions[indices[pos]], ans)
+                    remaining[txid] -= 1
+            if remaining[txid] <= 0:
+                del remaining[txid]
+        for txid in truncated:
+            indices = inflight[txid]
+            for i, ans in zip(indices, self._batch_over_tcp(txid, wires[txid], len(indices))):
+                if ans is not None and answers[i] is None:
+                    answers[i] = self._accept(*questions[i], ans)
+        return answers
+
+    def close(self):
+        """Closes the resolver's sockets."""
+        self.conn.close()
+        self.tcp.close()
 
-    code_to_name = {code: name for name, code in name_to_code.items()}
 
-    @staticmethod
-    def get_type_code(type_name: str):
-        """Gets the code for the given DNS query type name, or None"""
-        return DNSTypes.name_to_code.get(type_name, None)
+class AsyncResolver(ResolverBase):
+    """
+    The asyncio counterpart of Resolver: every query is an awaitable on one shared socket.
 
-    @staticmethod
-    def get_type_name(type_code: int):
-        """Gets the DNS query type name for the given code, or None"""
-        return DNSTypes.code_to_name.get(type_code, None)
+    The resolver is its own datagram protocol. asyncio is imported by the methods that
+    need it rather than by this module, so the interactive client starts without it.
 
+    Example:
+        async with AsyncResolver() as resolver:
+            answer = await resolver.resolve("shop.amazone.com")
+            answers = await resolver.resolve_many(names)
+    """
 
-class UDPConnection:
-    """A class to handle UDP socket communication, capable of acting as both a client and a server."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.transport = None
+        self.waiting = {}  # txid -> future
+        self.batches = {}  # txid -> (answers so far, future) for batch queries
+
+    async def open(self):
+        """Creates the UDP endpoint; called by `async with`."""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, remote_addr=self.server)
+        return self
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        parsed = self._parse_reply(data)
+        if parsed is None:
+            return
+        if parsed[0] in self.batches:
+            self._batch_part(*parsed)
+            return
+        fut = self.waiting.pop(parsed[0], None)
+        if fut is not None and not fut.done():
+            fut.set_result(parsed[1])
 
-    def __init__(self, timeout: int = 1):
-        """Initializes the UDPConnection instance with a timeout. Defaults to 1."""
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.settimeout(timeout)
-        self.is_bound = False
+    def error_received(self, exc):
+        # e.g. ECONNRESET when the server isn't up; the queries will time out
+        pass
 
-    def send_message(self, message: str, address: tuple[str, int]):
-        """Sends a message to the specified address."""
-        self.socket.sendto(message.encode(), address)
+    # The rest of asyncio.DatagramProtocol, which has nothing to do here
+    def connection_lost(self, exc):
+        pass
 
-    def receive_message(self):
-        """
-        Receives a message from the socket.
+    def pause_writing(self):
+        pass
 
-        Returns:
-            tuple (data, address): The received message and the address it came from.
+    def resume_writing(self):
+        pass
 
-        Raises:
-            KeyboardInterrupt: If the program is interrupted manually.
-        """
-        while True:
-            try:
-                data, address = self.socket.recvfrom(4096)
-                return data.decode(), address
-            except socket.timeout:
-                continue
-            except OSError as e:
-                if e.errno == errno.ECONNRESET:
-                    print("Error: Unable to reach the other socket. It might not be up and running.")
-                else:
-                    print(f"Socket error: {e}")
-                self.close()
-                sys.exit(1)
-            except KeyboardInterrupt:
-                raise
-
-    def bind(self, address: tuple[str, int]):
-        """Binds the socket to the given address. This means it will be a server."""
-        if self.is_bound:
-            print(f"Socket is already bound to address: {self.socket.getsockname()}")
+    async def resolve(self, name: str, rtype: str = "A"):
+        """Resolves one name; returns its answer or None on timeout."""
+        import asyncio
+        cached = self._cached(name, rtype)
+        if cached is not None:
+            return cached
+        txid, wire = self._query(name, rtype)
+        fut = asyncio.get_running_loop().create_future()
+        self.waiting[txid] = fut
+        self.transport.sendto(wire)
+        try:
+            ans = await asyncio.wait_for(fut, self.timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.waiting.pop(txid, None)
+        if ans.get("tc"):
+            # Too big for a datagram: ask again over the (blocking) TCP pool, off the event loop
+            ans = await asyncio.get_running_loop().run_in_executor(None, self._over_tcp, txid, wire)
+            if ans is None:
+                return None
+        return self._accept(name, rtype, ans)
+
+    async def resolve_many(self, names, rtype: str = "A"):
+        """Resolves hostnames or (hostname, type) pairs concurrently; returns answers in order."""
+        import asyncio
+        return await asyncio.gather(*(self.resolve(n, t) for n, t in self._questions(names, rtype)))
+
+    def _batch_part(self, txid, part):
+        entry = self.batches.get(txid)
+        if entry is None:
             return
-        self.socket.bind(address)
-        self.is_bound = True
+        received, fut = entry
+        if part.get("tc"):
+            # None tells resolve_batch to get this batch again over TCP
+            if not fut.done():
+                fut.set_result(None)
+            return
+        for pos, ans in enumerate(part["answers"], part["first"]):
+            if 0 <= pos < len(received) and isinstance(ans, dict):
+                received[pos] = ans
+        if None not in received and not fut.done():
+            fut.set_result(received)
+
+    async def resolve_batch(self, names, rtype: str = "A"):
+        """Like resolve_many(), but cache misses are sent as multi-question queries (see Resolver.resolve_batch)."""
+        import asyncio
+        questions = self._questions(names, rtype)
+        answers = [self._cached(name, qtype) for name, qtype in questions]
+        missing = [i for i, ans in enumerate(answers) if ans is None]
+        loop = asyncio.get_running_loop()
+        sent = []
+        for txid, wire, indices in self._batch_queries([questions[i] for i in missing]):
+            self.batches[txid] = ([None] * len(indices), loop.create_future())
+            sent.append((txid, wire, [missing[j] for j in indices]))
+            self.transport.sendto(wire)
+        try:
+            if sent:
+                await asyncio.wait([self.batches[txid][1] for txid, _, _ in sent], timeout=self.timeout)
+            for txid, wire, _indices in sent:
+                received, fut = self.batches[txid]
+                if fut.done() and fut.result() is None:
+                    # A part was truncated: get the whole batch again over TCP
+                    again = await loop.run_in_executor(None, self._batch_over_tcp, txid, wire, len(received))
+                    received[:] = [ans if ans is not None else tcp for ans, tcp in zip(received, again)]
+        finally:
+            for txid, _wire, indices in sent:
+                received, _fut = self.batches.pop(txid)
+                for i, ans in zip(indices, received):
+                    if ans is not None:
+                        answers[i] = self._accept(*questions[i], ans)
+        return answers
 
     def close(self):
-        """Closes the UDP socket."""
-        self.socket.close()
+        """Closes the resolver's sockets."""
+        if self.transport is not None:
+            self.transport.close()
+        self.tcp.close()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        self.close()
 
 
 if __name__ == "__main__":
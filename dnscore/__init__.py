@@ -0,0 +1,64 @@
+"""
+What client.py, localserver.py and amazoneserver.py have in common: the wire format, the
+resource record table with its zone files, the UDP and TCP transports, and the metrics.
+
+Names are imported from their submodule the first time they are used, so
+`from dnscore import serialize` does not pay for RRTable's snapshot and zone
+machinery, and a script starts up with only what it touches.
+
+Submodules:
+    protocol  DNSTypes, CODEC, serialize/deserialize/fit, message flags and result strings
+    wire      BinaryCodec, the binary wire format, and split_batch
+    record    Record, one row of an RRTable
+    rrtable   RRTable with its eviction policies, cache snapshots and NS delegations
+    zone      ZoneFile, authoritative records served from a memory-mapped index
+    udp       UDPConnection
+    tcp       length-prefixed framing, TCPListener for servers and TCPPool for their clients
+    metrics   Histogram, Rate and TimedLock counters, and format_stats to print them
+"""
+
+import importlib
+
+_EXPORTS = {
+    "DNSTypes": "protocol",
+    "CODEC": "protocol",
+    "serialize": "protocol",
+    "deserialize": "protocol",
+    "fit": "protocol",
+    "DATAGRAM_MAX": "protocol",
+    "STATS_FLAG": "protocol",
+    "STATS_REPLY_FLAG": "protocol",
+    "NOT_FOUND": "protocol",
+    "SERVFAIL": "protocol",
+    "REFUSED": "protocol",
+    "BinaryCodec": "wire",
+    "split_batch": "wire",
+    "Record": "record",
+    "RRTable": "rrtable",
+    "EVICTION_POLICIES": "rrtable",
+    "ZoneFile": "zone",
+    "UDPConnection": "udp",
+    "FRAME_MAX": "tcp",
+    "StreamAddress": "tcp",
+    "TCPListener": "tcp",
+    "TCPPool": "tcp",
+    "Histogram": "metrics",
+    "Rate": "metrics",
+    "TimedLock": "metrics",
+    "format_stats": "metrics",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value  # later lookups skip this function
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
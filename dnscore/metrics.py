@@ -0,0 +1,159 @@
+import threading
+import time
+
+
+class Histogram:
+    """
+    Latency histogram with power-of-two microsecond buckets.
+
+    observe() costs one bit_length() and a few additions, so it can stay on for every query.
+    Updates from several threads are not locked, so under contention a count can be lost now and then.
+    Percentiles are reported as the upper bound of the bucket they fall in, capped at the maximum seen.
+
+    Examples:
+    >>> h = Histogram()
+    >>> for ms in (1, 2, 3, 100):
+    ...     h.observe(ms / 1000)
+    >>> h.count, round(h.sum, 3)
+    (4, 0.106)
+    >>> h.percentile(0.5)
+    0.002048
+    >>> h.summary()["p99_ms"], Histogram().summary()
+    (100.0, {'count': 0})
+    """
+
+    BUCKETS = 32  # bucket b holds values below 2**b microseconds; the last one also holds everything above
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        """Records one value, in seconds."""
+        bucket = int(seconds * 1e6).bit_length()
+        self.counts[bucket if bucket < self.BUCKETS else self.BUCKETS - 1] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q: float):
+        """Upper bound, in seconds, of the bucket holding the q-th quantile; None if nothing was recorded."""
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for bucket, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min((1 << bucket) / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        """count, mean, p50, p99 and max, in milliseconds."""
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean_ms": round(self.sum / self.count * 1000, 3),
+            "p50_ms": round(self.percentile(0.50) * 1000, 3),
+            "p99_ms": round(self.percentile(0.99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+class Rate:
+    """
+    Events per second over the last WINDOW whole seconds, kept in one slot per second.
+
+    Example:
+    >>> r = Rate()
+    >>> r.mark(50, now=100.5); r.mark(30, now=101.2)
+    >>> r.per_second(now=102.0)
+    8.0
+    """
+
+    WINDOW = 10
+
+    def __init__(self):
+        self.slots = [0] * (self.WINDOW + 1)
+        self.stamps = [-1] * (self.WINDOW + 1)
+
+    def mark(self, n: int = 1, now: float | None = None):
+        """Counts n events at now (time.monotonic() by default)."""
+        second = int(time.monotonic() if now is None else now)
+        i = second % len(self.slots)
+        if self.stamps[i] != second:
+            self.stamps[i] = second
+            self.slots[i] = 0
+        self.slots[i] += n
+
+    def per_second(self, now: float | None = None):
+        """Average rate over the last WINDOW complete seconds."""
+        second = int(time.monotonic() if now is None else now)
+        total = sum(n for n, stamp in zip(self.slots, self.stamps) if second - self.WINDOW <= stamp < second)
+        return total / self.WINDOW
+
+
+class TimedLock:
+    """
+    A threading.Lock that records in a Histogram how long acquire() waited, but only when it had to.
+
+    The uncontended path is a single non-blocking acquire, so nothing is timed unless
+    another thread holds the lock. It can back a threading.Condition.
+
+    Example:
+    >>> waits = Histogram()
+    >>> lock = TimedLock(waits)
+    >>> with lock:
+    ...     lock.locked()
+    True
+    >>> waits.count
+    0
+    """
+
+    def __init__(self, waits: Histogram):
+        self._lock = threading.Lock()
+        self.waits = waits
+
+    def acquire(self, blocking: bool = True, timeout: float = -1):
+        if self._lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self._lock.acquire(True, timeout)
+        self.waits.observe(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+def format_stats(stats: dict, prefix: str = ""):
+    """
+    Renders a nested stats dict as "dotted.name value" lines, for reading in a terminal.
+
+    Example:
+    >>> print(format_stats({"queries": 3, "cache": {"hits": 2, "misses": 1}}))
+    queries 3
+    cache.hits 2
+    cache.misses 1
+    """
+    lines = []
+    for name, value in stats.items():
+        if isinstance(value, dict):
+            lines.append(format_stats(value, f"{prefix}{name}."))
+        else:
+            lines.append(f"{prefix}{name} {value}")
+    return "\n".join(line for line in lines if line)
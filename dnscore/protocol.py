@@ -0,0 +1,144 @@
+import json
+
+from dnscore.wire import BinaryCodec
+
+# A message with this flag asks a server for its counters; the reply has STATS_REPLY_FLAG
+STATS_FLAG = "0010"
+STATS_REPLY_FLAG = "0011"
+
+# Results that are not records
+NOT_FOUND = "Record not found"
+# upstream never answered (cf. DNS SERVFAIL)
+SERVFAIL = "Server failure"
+# the server was too busy to look (cf. DNS REFUSED)
+REFUSED = "Query refused"
+
+# Largest message sent in one datagram, and what a receiver reads from one. A response
+# that would not fit goes out truncated (see fit) and is asked for again over TCP
+DATAGRAM_MAX = 4096
+
+
+class DNSTypes:
+    """
+    A class to manage DNS query types and their corresponding codes.
+
+    Examples:
+    >>> DNSTypes.get_type_code('A')
+    8
+    >>> DNSTypes.get_type_name(0b0100)
+    'AAAA'
+    >>> DNSTypes.get_type_code('MX') is None
+    True
+    """
+
+    name_to_code = {
+        "A": 0b1000,
+        "AAAA": 0b0100,
+        "CNAME": 0b0010,
+        "NS": 0b0001,
+    }
+
+    code_to_name = {code: name for name, code in name_to_code.items()}
+
+    @staticmethod
+    def get_type_code(type_name: str):
+        """Gets the code for the given DNS query type name, or None"""
+        return DNSTypes.name_to_code.get(type_name)
+
+    @staticmethod
+    def get_type_name(type_code: int):
+        """Gets the DNS query type name for the given code, or None"""
+        return DNSTypes.code_to_name.get(type_code)
+
+
+CODEC = BinaryCodec(DNSTypes.name_to_code)
+
+
+def serialize(message: dict, binary: bool = False):
+    """
+    Encodes a message for the wire: packed by CODEC when binary is set and the message
+    fits the binary layout, compact JSON text otherwise.
+
+    Examples:
+    >>> serialize({"txid": 1, "flag": "0000", "question": {"name": "shop.amazone.com", "type": "A"}})
+    '{"txid":1,"flag":"0000","question":{"name":"shop.amazone.com","type":"A"}}'
+    >>> serialize({"txid": 1, "flag": "0000", "question": {"name": "shop.amazone.com", "type": "A"}}, binary=True)[:1]
+    b'\\xd5'
+    >>> serialize({"txid": 1, "flag": "0010"}, binary=True)
+    '{"txid":1,"flag":"0010"}'
+    """
+    if binary:
+        packed = CODEC.encode(message)
+        if packed is not None:
+            return packed
+    return json.dumps(message, separators=(",", ":"))
+
+
+def deserialize(wire):
+    """
+    Decodes a received datagram (JSON str, or binary bytes/memoryview) into a message dict;
+    {} when it is malformed, so callers only have to check for the fields they need.
+
+    Examples:
+    >>> msg = {"txid": 1, "flag": "0001", "answer": {"name": "a.test", "type": "A", "ttl": 5, "result": "10.0.0.1"}}
+    >>> deserialize(serialize(msg)) == deserialize(serialize(msg, binary=True)) == msg
+    True
+    >>> deserialize("{not json"), deserialize(b"\\xd5\\x00"), deserialize("[" * 3000)
+    ({}, {}, {})
+    """
+    if BinaryCodec.is_binary(wire):
+        return CODEC.decode(wire) or {}
+    try:
+        return json.loads(wire)
+    except (ValueError, RecursionError):
+        # json.loads recurses once per nesting level, so one datagram of "[[[[..." is enough to hit the limit
+        return {}
+
+
+def truncated(message: dict):
+    """
+    The stand-in for a response too big to send: the same txid with "tc": 1 (cf. the DNS TC bit),
+    carrying the question(s) it answers instead of the answers, so the receiver can tell which
+    query to send again over TCP.
+
+    Examples:
+    >>> truncated({"txid": 5, "flag": "0001", "answer": {"name": "a.test", "type": "A", "ttl": 5, "result": "x"}})
+    {'txid': 5, 'flag': '0001', 'tc': 1, 'question': {'name': 'a.test', 'type': 'A'}}
+    >>> truncated({"txid": 5, "flag": "0001", "first": 2, "answers": [{"name": "a.test", "type": "A", "txid": 9}]})
+    {'txid': 5, 'flag': '0001', 'tc': 1, 'first': 2, 'questions': [{'name': 'a.test', 'type': 'A', 'txid': 9}]}
+    """
+    stub = {"txid": message.get("txid"), "flag": message.get("flag"), "tc": 1}
+    if isinstance(message.get("answers"), list):
+        stub["first"] = message.get("first", 0)
+        stub["questions"] = [_question_of(answer) for answer in message["answers"]]
+    else:
+        stub["question"] = _question_of(message.get("answer"))
+    return stub
+
+
+def _question_of(answer):
+    answer = answer if isinstance(answer, dict) else {}
+    question = {"name": answer.get("name", ""), "type": answer.get("type", "")}
+    if "txid" in answer:
+        question["txid"] = answer["txid"]
+    return question
+
+
+def fit(message: dict, binary: bool = False, limit: int = DATAGRAM_MAX):
+    """
+    serialize() for a message that has to fit in limit bytes. Returns (wire, cut): a response
+    that is too big is replaced by its truncated() stand-in, and cut says so. Other messages
+    are never cut.
+
+    Examples:
+    >>> big = {"txid": 5, "flag": "0001", "answer": {"name": "a.test", "type": "A", "ttl": 5, "result": "x" * 5000}}
+    >>> fit(big)
+    ('{"txid":5,"flag":"0001","tc":1,"question":{"name":"a.test","type":"A"}}', True)
+    >>> fit(big, limit=0xFFFF)[1]
+    False
+    """
+    wire = serialize(message, binary)
+    # JSON is ASCII-only (json.dumps escapes the rest), so len() counts bytes for both formats
+    if len(wire) <= limit or message.get("flag") != "0001":
+        return wire, False
+    return serialize(truncated(message)), True
@@ -0,0 +1,44 @@
+class Record:
+    """
+    One row of an RRTable.
+
+    With __slots__ a record takes a fraction of the memory a dict did, and its fields
+    are read as plain attributes, which is also faster on the hot paths.
+
+    Fields:
+        record_number  position in the table when it was added (None for zone records)
+        name, type, result
+        ttl            seconds left, recomputed on every read; None for static records
+        static         1 for authoritative records that never expire, else 0
+        negative       1 for a cached "Record not found"
+        expires        time.monotonic() deadline; None for static records
+        seq            key in RRTable.records (None for zone records)
+        orig_ttl       ttl when the record was cached, for refresh-ahead
+        hits           lookups that returned it, for refresh-ahead and LFU eviction
+        prefetching    a refresh is already on its way
+
+    Example:
+    >>> r = Record(0, "shop.amazone.com", "A", "3.33.147.88", 60, 0, expires=100.0, seq=0)
+    >>> r.name, r.result, r.orig_ttl, r.hits, r.prefetching
+    ('shop.amazone.com', '3.33.147.88', 60, 0, False)
+    """
+
+    __slots__ = ("record_number", "name", "type", "result", "ttl", "static", "negative",
+                 "expires", "seq", "orig_ttl", "hits", "prefetching")
+
+    def __init__(self, record_number, name, type, result, ttl, static, negative=0, expires=None, seq=None):
+        self.record_number = record_number
+        self.name = name
+        self.type = type
+        self.result = result
+        self.ttl = ttl
+        self.static = static
+        self.negative = negative
+        self.expires = expires
+        self.seq = seq
+        self.orig_ttl = ttl
+        self.hits = 0
+        self.prefetching = False
+
+    def __repr__(self):
+        return f"Record({self.name!r}, {self.type!r}, {self.result!r}, ttl={self.ttl!r}, static={self.static})"
@@ -0,0 +1,436 @@
+import heapq
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from dnscore.metrics import Histogram, TimedLock
+from dnscore.protocol import NOT_FOUND, DNSTypes
+from dnscore.record import Record
+
+# ---------- Cache eviction policies ----------
+# Each policy tracks the dynamic (non-static) records by seq and picks the
+# one to drop when the RRTable is over its max_entries.
+class LRUPolicy:
+    # least recently used first
+    def __init__(self): self.order = OrderedDict()
+    def insert(self, seq, r): self.order[seq] = None
+    def touch(self, seq): self.order.move_to_end(seq)
+    def remove(self, seq): self.order.pop(seq, None)
+    def victim(self): return next(iter(self.order), None)
+
+class LFUPolicy:
+    # fewest hits first, oldest first among equals; stale heap items are skipped lazily
+    def __init__(self):
+        self.counts = {}
+        self.heap = []
+    def insert(self, seq, r):
+        self.counts[seq] = 0
+        heapq.heappush(self.heap, (0, seq))
+    def touch(self, seq):
+        c = self.counts[seq] + 1
+        self.counts[seq] = c
+        heapq.heappush(self.heap, (c, seq))
+        self._compact()
+    def remove(self, seq):
+        self.counts.pop(seq, None)
+        self._compact()
+    def _compact(self):
+        # rebuild once stale items outnumber live ones 4:1, so the heap stays O(live)
+        if len(self.heap) > 4 * len(self.counts) + 64:
+            self.heap = [(c, seq) for seq, c in self.counts.items()]
+            heapq.heapify(self.heap)
+    def victim(self):
+        while self.heap:
+            c, seq = self.heap[0]
+            if self.counts.get(seq) == c: return seq
+            heapq.heappop(self.heap)
+        return None
+
+class EarliestExpiryPolicy:
+    # the record closest to expiring first
+    def __init__(self):
+        self.live = {}  # seq -> expires
+        self.heap = []
+    def insert(self, seq, r):
+        self.live[seq] = r.expires
+        heapq.heappush(self.heap, (r.expires, seq))
+    def touch(self, seq): pass
+    def remove(self, seq):
+        self.live.pop(seq, None)
+        # as in LFUPolicy: rebuild once stale items outnumber live ones 4:1
+        if len(self.heap) > 4 * len(self.live) + 64:
+            self.heap = [(expires, seq) for seq, expires in self.live.items()]
+            heapq.heapify(self.heap)
+    def victim(self):
+        while self.heap:
+            if self.heap[0][1] in self.live: return self.heap[0][1]
+            heapq.heappop(self.heap)
+        return None
+
+EVICTION_POLICIES = {"lru": LRUPolicy, "lfu": LFUPolicy, "expiry": EarliestExpiryPolicy}
+
+# ---------- Cache snapshots ----------
+class CacheSnapshot:
+    # On-disk copy of the dynamic cache, for warm restarts. After MAGIC, each
+    # entry is ENTRY (wall-clock expiry, DNSTypes code, flags, name length,
+    # result length) followed by the UTF-8 name and result. Wall-clock expiry
+    # is used because monotonic time does not survive a reboot.
+    # Reading is lazy: the file is mmapped and only the names are scanned, to
+    # index (name, type) -> offsets; an entry is decoded when it is first asked for.
+    MAGIC = b"RRSNAP1\n"
+    ENTRY = struct.Struct("!dBBBH")
+    NEGATIVE = 0b1
+
+    @classmethod
+    def write(cls, path, entries):
+        # entries: (name, type, result, expires_wall, negative); written to a temp file then renamed
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(cls.MAGIC)
+            for name, rtype, result, expires_wall, negative in entries:
+                code = DNSTypes.get_type_code(rtype)
+                n, res = name.encode(), result.encode()
+                if code is None or len(n) > 0xFF or len(res) > 0xFFFF: continue
+                f.write(cls.ENTRY.pack(expires_wall, code, cls.NEGATIVE if negative else 0, len(n), len(res)))
+                f.write(n); f.write(res)
+        os.replace(tmp, path)
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = None
+        self.index = {}
+        size = os.fstat(self.file.fileno()).st_size
+        if size <= len(self.MAGIC): return
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError(f"{path} is not a cache snapshot")
+        now = time.time()
+        off = len(self.MAGIC)
+        while off + self.ENTRY.size <= size:
+            expires_wall, code, _flags, nlen, rlen = self.ENTRY.unpack_from(self.map, off)
+            end = off + self.ENTRY.size + nlen + rlen
+            if end > size: break  # truncated tail
+            rtype = DNSTypes.get_type_name(code)
+            if expires_wall > now and rtype is not None:
+                name = self.map[off+self.ENTRY.size:off+self.ENTRY.size+nlen].decode(errors="replace")
+                self.index.setdefault(RRTable.key(name, rtype), []).append(off)
+            off = end
+
+    def __len__(self): return sum(len(v) for v in self.index.values())
+
+    def _decode(self, off):
+        expires_wall, code, flags, nlen, rlen = self.ENTRY.unpack_from(self.map, off)
+        start = off + self.ENTRY.size
+        name = self.map[start:start+nlen].decode(errors="replace")
+        result = self.map[start+nlen:start+nlen+rlen].decode(errors="replace")
+        return name, DNSTypes.get_type_name(code), result, expires_wall, bool(flags & self.NEGATIVE)
+
+    def take(self, key):
+        # decode and forget the entries for key that have not expired yet
+        now = time.time()
+        return [e for e in map(self._decode, self.index.pop(key, ())) if e[3] > now]
+
+    def entries(self):
+        # everything not yet taken, e.g. to carry it into the next snapshot
+        now = time.time()
+        return [e for offs in self.index.values() for e in map(self._decode, offs) if e[3] > now]
+
+    def close(self):
+        if self.map is not None: self.map.close()
+        self.file.close()
+
+# ---------- NS delegation ----------
+class DelegationTrie:
+    # NS records keyed by reversed labels (amazone.com -> com -> amazone), so the
+    # closest enclosing zone cut for a name is one walk over its labels.
+    # A node's "ns" maps record seq -> nameserver host, so an expiring NS record
+    # takes exactly its own delegation with it. "version" changes whenever a
+    # delegation or the address of a nameserver host does; lookups cached
+    # elsewhere are only good for one version.
+    def __init__(self):
+        self.root = {"children": {}, "ns": {}}
+        self.hosts = {}     # nameserver host -> number of NS records naming it
+        self.version = 0
+    @staticmethod
+    def labels(name): return [l for l in reversed(name.lower().rstrip(".").split(".")) if l]
+    def insert(self, zone, host, seq):
+        node = self.root
+        for label in self.labels(zone):
+            node = node["children"].setdefault(label, {"children": {}, "ns": {}})
+        node["ns"][seq] = host
+        host = host.lower()
+        self.hosts[host] = self.hosts.get(host, 0) + 1
+        self.version += 1
+    def remove(self, zone, seq):
+        path, node = [], self.root
+        for label in self.labels(zone):
+            path.append((node, label))
+            node = node["children"].get(label)
+            if node is None: return
+        host = node["ns"].pop(seq, None)
+        if host is None: return
+        host = host.lower()
+        self.hosts[host] -= 1
+        if not self.hosts[host]: del self.hosts[host]
+        # prune the branch back to the last node still in use
+        for parent, label in reversed(path):
+            child = parent["children"][label]
+            if child["ns"] or child["children"]: break
+            del parent["children"][label]
+        self.version += 1
+    def is_host(self, name): return name.lower() in self.hosts
+    def closest(self, name):
+        # (zone, [ns hosts]) of the deepest delegation enclosing name, or None
+        found, node, labels = None, self.root, self.labels(name)
+        for depth, label in enumerate(labels, 1):
+            node = node["children"].get(label)
+            if node is None: break
+            if node["ns"]: found = (".".join(reversed(labels[:depth])), list(node["ns"].values()))
+        return found
+
+class RRTable:
+    # rows are Records (see record.py); orig_ttl/hits let the server spot hot
+    # records worth refreshing early, and negative=1 marks a cached
+    # "Record not found" answer for (name, type).
+    # records keeps insertion order for display_table; index maps the
+    # normalized (name, type) key to every record stored under it.
+    # Cached records carry an absolute monotonic deadline in expires;
+    # ttl is recomputed from it whenever the record is read, and a
+    # min-heap of (expires, seq) lets the expiry thread evict only what is due.
+    # With max_entries set, the dynamic part of the table is capped and the
+    # eviction policy picks what goes; static records are never evicted.
+    """
+    The one RRTable behind client.py, localserver.py and amazoneserver.py. What each of
+    their old copies did still holds:
+
+    >>> rr = RRTable()
+    >>> rr.add_record("shop.amazone.com", "A", "3.33.147.88", None, True)
+    >>> rr.add_record("shop.amazone.com", "A", "3.33.147.89", None, True)
+    >>> rr.add_record("typo.amazone.com", "A", NOT_FOUND, 30, False, is_negative=True)
+    >>> rr.add_record("www.amazone.com", "CNAME", "shop.amazone.com", 60, False)
+
+    Lookups ignore case, return the first live record, or every one with get_records():
+
+    >>> r = rr.get_record("SHOP.Amazone.com", "a")
+    >>> (r.record_number, r.name, r.result, r.ttl, r.static) == (0, "shop.amazone.com", "3.33.147.88", None, 1)
+    True
+    >>> [r.result for r in rr.get_records("shop.amazone.com", "A")]
+    ['3.33.147.88', '3.33.147.89']
+    >>> rr.get_record("cloud.amazone.com", "A") is None
+    True
+
+    Cached records count down from their ttl and are gone once it runs out:
+
+    >>> neg = rr.get_record("typo.amazone.com", "A")
+    >>> neg.ttl, neg.negative, neg.static
+    (30, 1, 0)
+    >>> rr.add_record("soon.amazone.com", "A", "10.0.0.1", 0, False)
+    >>> rr.get_record("soon.amazone.com", "A") is None
+    True
+    >>> rr.display_table()
+    record_number,name,type,result,ttl,static
+    0,shop.amazone.com,A,3.33.147.88,None,1
+    1,shop.amazone.com,A,3.33.147.89,None,1
+    2,typo.amazone.com,A,Record not found,30,0
+    3,www.amazone.com,CNAME,shop.amazone.com,60,0
+    """
+    def __init__(self, max_entries:int|None=None, policy:str="lru"):
+        self.records = {}
+        self.index = {}
+        self.heap = []
+        self.record_number = 0
+        self.seq = 0
+        self.max_entries = max_entries
+        self.policy = EVICTION_POLICIES[policy]()
+        self.dynamic = 0
+        self.stats = {"hits":0,"misses":0,"evictions":0,"expirations":0}
+        # CacheSnapshot still holding entries not yet looked up, if any
+        self.snapshot = None
+        # memory-mapped authoritative zones, consulted when the table itself misses
+        self.zones = []
+        # NS records in the table, for routing queries to the right server
+        self.delegations = DelegationTrie()
+        # how long threads had to wait for the table lock, when they did
+        self.lock_waits = Histogram()
+        self.lock = TimedLock(self.lock_waits)
+        self.cv = threading.Condition(self.lock)
+        t = threading.Thread(target=self.__expire_records, daemon=True); t.start()
+    @staticmethod
+    def key(name, rtype): return (name.lower(), rtype.upper())
+    @staticmethod
+    def _remaining(expires, now):
+        # seconds left, rounded up so a fresh 60s record reads 60 for its first second
+        return math.ceil(expires - now)
+    @staticmethod
+    def _refresh(r, now):
+        # fill in the read-time ttl; False if the record is already due
+        if r.static: return True
+        r.ttl = ttl = math.ceil(r.expires - now)
+        return ttl > 0
+    def add_record(self, name, rtype, result, ttl:int|None, is_static:bool, is_negative:bool=False,
+                   expires:float|None=None, replace:bool=False):
+        # expires: absolute time.monotonic() deadline, overriding ttl (records shared between workers)
+        # replace: drop the cached (non-static) records for (name, type) first, e.g. on refresh
+        with self.lock:
+            self._add(name, rtype, result, ttl, is_static, is_negative, expires, replace)
+    def _add(self, name, rtype, result, ttl, is_static, is_negative=False, expires=None, replace=False):
+        # caller holds the lock
+        if replace:
+            for x in list(self.index.get(self.key(name, rtype), ())):
+                if not x.static: self._remove(x.seq)
+        ttl = None if is_static else int(ttl or 0)
+        if not is_static:
+            if expires is None: expires = time.monotonic() + ttl
+            else: ttl = self._remaining(expires, time.monotonic())
+            # make room first, so the record being added is never its own victim
+            if self.max_entries is not None:
+                if self.max_entries <= 0: return
+                while self.dynamic >= self.max_entries:
+                    self._remove(self.policy.victim())
+                    self.stats["evictions"] += 1
+        r = Record(len(self.records), name, rtype, result, ttl, 1 if is_static else 0, 1 if is_negative else 0,
+                   None if is_static else expires, self.seq)
+        self.records[self.seq] = r
+        self.index.setdefault(self.key(name, rtype), []).append(r)
+        self._track_delegation(r, added=True)
+        if not is_static:
+            heapq.heappush(self.heap, (r.expires, self.seq))
+            # wake the expiry thread only if this is the new earliest deadline
+            if self.heap[0][1] == self.seq: self.cv.notify()
+            self.policy.insert(self.seq, r)
+            self.dynamic += 1
+            # evicted records leave stale deadlines behind; rebuild once they dominate
+            if len(self.heap) > 4 * self.dynamic + 64:
+                self.heap = [(x.expires, q) for q,x in self.records.items() if not x.static]
+                heapq.heapify(self.heap)
+        self.record_number = len(self.records)
+        self.seq += 1
+    def get_record(self, name, rtype):
+        with self.lock:
+            now = time.monotonic()
+            for r in self._bucket(self.key(name, rtype)):
+                if self._refresh(r, now):
+                    self.stats["hits"] += 1
+                    if not r.static:
+                        r.hits += 1
+                        self.policy.touch(r.seq)
+                    return r
+            self.stats["misses"] += 1
+            return None
+    def add_negative(self, name, rtype, ttl:int, expires:float|None=None):
+        # cache that (name, type) does not exist upstream
+        self.add_record(name, rtype, NOT_FOUND, ttl, is_static=False, is_negative=True, expires=expires)
+    def get_records(self, name, rtype):
+        # every live record for (name, type), e.g. several A answers
+        with self.lock:
+            now = time.monotonic()
+            return [r for r in self._bucket(self.key(name, rtype)) if self._refresh(r, now)]
+    def _bucket(self, k):
+        # caller holds the lock; zones answer before the snapshot is pulled in
+        bucket = self.index.get(k)
+        if bucket is None and self.zones:
+            zone_records = self._from_zones(k)
+            if zone_records: return zone_records
+        if bucket is None and self.snapshot is not None:
+            self._load_from_snapshot(k)
+            bucket = self.index.get(k)
+        return bucket or ()
+    def _load_from_snapshot(self, k):
+        now_wall, now = time.time(), time.monotonic()
+        for name, rtype, result, expires_wall, negative in self.snapshot.take(k):
+            self._add(name, rtype, result, None, False, negative, expires=now + (expires_wall - now_wall))
+        if not self.snapshot.index:
+            self.snapshot.close(); self.snapshot = None
+    def _track_delegation(self, r, added):
+        # caller holds the lock
+        if r.negative: return
+        rtype = r.type.upper()
+        if rtype == "NS":
+            if added: self.delegations.insert(r.name, r.result, r.seq)
+            else: self.delegations.remove(r.name, r.seq)
+        elif rtype == "A" and self.delegations.is_host(r.name):
+            self.delegations.version += 1   # a nameserver's address changed
+    def delegation(self, name):
+        # closest zone cut for name as (zone, [ns hosts]), or None; the trie covers the
+        # table, zone files are asked suffix by suffix for anything deeper
+        with self.lock:
+            found = self.delegations.closest(name)
+            if self.zones:
+                labels = [l for l in name.lower().rstrip(".").split(".") if l]
+                for i in range(len(labels)):
+                    suffix = ".".join(labels[i:])
+                    if found and len(suffix) <= len(found[0]): break
+                    for zone in self.zones:
+                        hosts = [result for _, _, result, _ in zone.lookup(suffix, "NS")]
+                        if hosts: return suffix, hosts
+            return found
+    def _from_zones(self, k):
+        # zone records are built per lookup rather than stored, so a large zone costs no table memory
+        for zone in self.zones:
+            found = zone.lookup(*k)
+            if found:
+                return [Record(None, name, rtype, result, ttl, 1) for name, rtype, result, ttl in found]
+        return []
+    def load_zone(self, path):
+        from dnscore.zone import ZoneFile  # only servers with --zone pay for it
+        zone = ZoneFile(path)
+        with self.lock: self.zones.append(zone)
+        return len(zone)
+    def load_snapshot(self, path):
+        # map a snapshot written by save_snapshot; entries load on first lookup
+        try:
+            snap = CacheSnapshot(path)
+        except (OSError, ValueError) as e:
+            print(f"Cache snapshot not loaded: {e}")
+            return 0
+        with self.lock:
+            if self.snapshot is not None: self.snapshot.close()
+            self.snapshot = snap if snap.index else None
+        if self.snapshot is None: snap.close()
+        return len(snap.index)
+    def save_snapshot(self, path):
+        with self.lock:
+            now_wall, now = time.time(), time.monotonic()
+            entries = [(r.name, r.type, r.result, now_wall + (r.expires - now), r.negative)
+                       for r in self.records.values() if not r.static and r.expires > now]
+            if self.snapshot is not None: entries += self.snapshot.entries()
+        CacheSnapshot.write(path, entries)
+        return len(entries)
+    def display_table(self):
+        # copy the rows under the lock, format and print them after releasing it
+        with self.lock:
+            now = time.monotonic()
+            rows = [(r.name, r.type, r.result, r.ttl, r.static)
+                    for r in self.records.values() if self._refresh(r, now)]
+            zones = [(zone.path, len(zone)) for zone in self.zones]
+        lines = ["record_number,name,type,result,ttl,static"]
+        lines += [f'{i},{name},{rtype},{result},{"None" if ttl is None else ttl},{static}'
+                  for i,(name,rtype,result,ttl,static) in enumerate(rows)]
+        lines += [f"# zone {path}: {n} static records" for path,n in zones]
+        print("\n".join(lines))
+    def _remove(self, seq):
+        # caller holds the lock; False if seq was already gone
+        r = self.records.pop(seq, None)
+        if r is None: return False
+        if not r.static:
+            self.policy.remove(seq)
+            self.dynamic -= 1
+        self._track_delegation(r, added=False)
+        k = self.key(r.name, r.type)
+        bucket = [x for x in self.index[k] if x is not r]
+        if bucket: self.index[k] = bucket
+        else: del self.index[k]
+        self.record_number = len(self.records)
+        return True
+    def __expire_records(self):
+        with self.cv:
+            while True:
+                now = time.monotonic()
+                while self.heap and self.heap[0][0] <= now:
+                    _, seq = heapq.heappop(self.heap)
+                    if self._remove(seq): self.stats["expirations"] += 1
+                self.cv.wait(self.heap[0][0] - now if self.heap else None)
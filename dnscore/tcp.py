@@ -0,0 +1,245 @@
+import collections
+import socket
+import struct
+import threading
+
+from dnscore.wire import BinaryCodec
+
+# Each message on a connection is preceded by its length, as DNS over TCP does (RFC 1035 4.2.2)
+LENGTH = struct.Struct("!H")
+FRAME_MAX = 0xFFFF
+# seconds a server keeps a quiet client connection open
+IDLE_TIMEOUT = 30
+# connections a TCPListener serves at once; any more are closed as soon as they are accepted
+MAX_CONNECTIONS = 256
+# idle connections a TCPPool keeps to each server
+POOL_IDLE = 4
+
+
+def frame(message) -> bytes:
+    """
+    Prefixes a message (JSON text or binary bytes) with its length.
+
+    Example:
+    >>> frame('{"txid":1}')
+    b'\\x00\\n{"txid":1}'
+    """
+    data = message.encode() if isinstance(message, str) else bytes(message)
+    if len(data) > FRAME_MAX:
+        raise ValueError(f"message of {len(data)} bytes is too big for a frame")
+    return LENGTH.pack(len(data)) + data
+
+
+def unframe(buffer: bytearray) -> list:
+    """
+    Takes every complete message off the front of buffer and returns them, decoded the way
+    UDPConnection.receive_message does: str for JSON, bytes for the binary format.
+    A partial message is left in buffer for the next read to complete.
+
+    Example:
+    >>> buffer = bytearray(frame('{"txid":1}') + frame(b"\\xd5\\x00") + frame("{}")[:3])
+    >>> unframe(buffer), bytes(buffer)
+    (['{"txid":1}', b'\\xd5\\x00'], b'\\x00\\x02{')
+    """
+    messages, offset = [], 0
+    while len(buffer) - offset >= LENGTH.size:
+        (length,) = LENGTH.unpack_from(buffer, offset)
+        end = offset + LENGTH.size + length
+        if end > len(buffer):
+            break
+        data = bytes(buffer[offset + LENGTH.size:end])
+        messages.append(data if BinaryCodec.is_binary(data) else data.decode(errors="replace"))
+        offset = end
+    del buffer[:offset]
+    return messages
+
+
+class StreamAddress(tuple):
+    """
+    The (host, port) of a client that asked over TCP, carrying the connection its replies go back on.
+
+    It compares, hashes and prints like the plain address, so rate limiting and logging treat
+    both transports alike; senders check for .stream to pick the transport.
+    """
+
+    def __new__(cls, address, stream):
+        self = super().__new__(cls, address[:2])
+        self.stream = stream
+        return self
+
+
+class TCPStream:
+    """
+    One TCP connection carrying length-prefixed messages in both directions.
+
+    Any number of threads may send on it; each message goes out whole.
+    """
+
+    def __init__(self, sock: socket.socket, timeout: float | None = None):
+        """timeout: how long receive_message() waits before raising socket.timeout (None = forever)."""
+        self.socket = sock
+        self.socket.settimeout(timeout)
+        # queries and answers are small: don't hold them back waiting for more to send
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = bytearray()
+        self.received = collections.deque()
+        self.send_lock = threading.Lock()
+
+    @classmethod
+    def connect(cls, address: tuple[str, int], timeout: float):
+        return cls(socket.create_connection(address, timeout), timeout)
+
+    def send_message(self, message: str | bytes):
+        """Sends one message; raises OSError if the connection is gone."""
+        data = frame(message)
+        with self.send_lock:
+            self.socket.sendall(data)
+
+    def receive_message(self):
+        """Returns the next message, or None once the peer has closed the connection."""
+        while not self.received:
+            chunk = self.socket.recv(65536)
+            if not chunk:
+                return None
+            self.buffer += chunk
+            self.received.extend(unframe(self.buffer))
+        return self.received.popleft()
+
+    def close(self):
+        self.socket.close()
+
+
+class TCPListener:
+    """
+    The TCP side of a server, on the same address as its UDP socket.
+
+    Every message received on an accepted connection is passed to handler(message, address),
+    one thread per connection, where address is a StreamAddress: replies sent to it go back on
+    that connection. A client can send as many queries as it likes on one connection; it is
+    closed once it has been quiet for idle_timeout seconds.
+
+    Example:
+    >>> listener = TCPListener(("127.0.0.1", 0))
+    >>> listener.serve(lambda message, address: address.stream.send_message(message.upper()))
+    >>> pool, replies = TCPPool(timeout=1), []
+    >>> for message in ('{"txid":1}', '{"txid":2}'):
+    ...     pool.exchange(message, listener.socket.getsockname(), lambda reply: replies.append(reply) or True)
+    True
+    True
+    >>> replies, len(pool.idle[listener.socket.getsockname()])
+    (['{"TXID":1}', '{"TXID":2}'], 1)
+    >>> pool.close(); listener.close()
+    """
+
+    def __init__(self, address: tuple[str, int], reuse_port: bool = False, idle_timeout: float = IDLE_TIMEOUT,
+                 max_connections: int = MAX_CONNECTIONS):
+        """reuse_port: let several worker processes listen on the address; the kernel spreads connections across them."""
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(address)
+        self.socket.listen(128)
+        self.idle_timeout = idle_timeout
+        self.slots = threading.BoundedSemaphore(max_connections)
+
+    def serve(self, handler):
+        """Starts accepting connections in a background thread."""
+        threading.Thread(target=self._accept, args=(handler,), name="tcp-accept", daemon=True).start()
+
+    def _accept(self, handler):
+        while True:
+            try:
+                sock, peer = self.socket.accept()
+            except OSError:
+                return  # listener closed
+            if not self.slots.acquire(blocking=False):
+                sock.close()
+                continue
+            stream = TCPStream(sock, self.idle_timeout)
+            threading.Thread(target=self._serve_stream, args=(stream, peer, handler), daemon=True).start()
+
+    def _serve_stream(self, stream, peer, handler):
+        address = StreamAddress(peer, stream)
+        try:
+            while (message := stream.receive_message()) is not None:
+                handler(message, address)
+        except OSError:
+            pass  # quiet for too long (socket.timeout), or reset by the client
+        finally:
+            stream.close()
+            self.slots.release()
+
+    def close(self):
+        self.socket.close()
+
+
+class TCPPool:
+    """
+    Persistent TCP connections to servers, kept open and reused from one exchange to the next,
+    so asking again over TCP after a truncated reply costs a round trip rather than a handshake.
+
+    Safe to share between threads: each exchange has a connection to itself.
+    """
+
+    def __init__(self, timeout: float = 3.0, max_idle: int = POOL_IDLE):
+        """
+        timeout: seconds to wait for a connection or for each reply.
+        max_idle: connections kept open to each server between exchanges.
+        """
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle = {}  # address -> [TCPStream]
+        self.lock = threading.Lock()
+
+    def exchange(self, message: str | bytes, address: tuple[str, int], on_reply) -> bool:
+        """
+        Sends message to address and passes each message that comes back to on_reply, until it returns True.
+
+        Returns True once it does, and False if the server can't be reached, hangs up, or stays
+        silent for timeout seconds. A pooled connection the server has closed since it was last
+        used is replaced by a new one rather than counted as a failure.
+        """
+        while True:
+            with self.lock:
+                idle = self.idle.get(address)
+                stream = idle.pop() if idle else None
+            reused = stream is not None
+            try:
+                if stream is None:
+                    stream = TCPStream.connect(address, self.timeout)
+                stream.send_message(message)
+                while True:
+                    reply = stream.receive_message()
+                    if reply is None:
+                        raise ConnectionResetError("connection closed by the server")
+                    if on_reply(reply):
+                        break
+            except socket.timeout:
+                if stream is not None:
+                    stream.close()
+                return False
+            except OSError:
+                if stream is not None:
+                    stream.close()
+                if reused:
+                    continue
+                return False
+            self._release(address, stream)
+            return True
+
+    def _release(self, address, stream):
+        with self.lock:
+            idle = self.idle.setdefault(address, [])
+            if len(idle) < self.max_idle:
+                idle.append(stream)
+                return
+        stream.close()
+
+    def close(self):
+        """Closes every idle connection."""
+        with self.lock:
+            streams = [stream for idle in self.idle.values() for stream in idle]
+            self.idle.clear()
+        for stream in streams:
+            stream.close()
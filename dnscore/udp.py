@@ -0,0 +1,144 @@
+import contextlib
+import errno
+import select
+import selectors
+import socket
+import threading
+
+from dnscore.protocol import DATAGRAM_MAX
+from dnscore.wire import BinaryCodec
+
+# batched mode: datagrams read per wakeup, each into a buffer of DATAGRAM_MAX bytes
+RECV_BATCH = 64
+
+
+class UDPConnection:
+    """
+    A class to handle UDP socket communication, capable of acting as both a client and a server.
+
+    Received datagrams come back as str for JSON and as bytes (or memoryviews, in batched
+    mode) for the binary format, ready for deserialize().
+
+    Example:
+    >>> server, client = UDPConnection(), UDPConnection()
+    >>> server.bind(("127.0.0.1", 0))
+    >>> client.send_message('{"txid":1}', server.socket.getsockname())
+    >>> server.receive_message()[0]
+    '{"txid":1}'
+    >>> server.close(); client.close()
+    """
+
+    def __init__(self, timeout: float = 1, reuse_port: bool = False, batched: bool = False):
+        """
+        timeout: how long a blocking receive waits before polling again (or raising, for callers
+            that use the socket directly).
+        reuse_port: let several worker processes bind the same address; the kernel spreads
+            datagrams across them.
+        batched: non-blocking socket drained by receive_batch() whenever a selector says it is readable.
+        """
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.is_bound = False
+        # per thread: replies held back by corked()
+        self.cork = threading.local()
+        self.selector = None
+        if batched:
+            self.socket.setblocking(False)
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.socket, selectors.EVENT_READ)
+            self.buffers = [memoryview(bytearray(DATAGRAM_MAX)) for _ in range(RECV_BATCH)]
+        else:
+            self.socket.settimeout(timeout)
+
+    def bind(self, address: tuple[str, int]):
+        """Binds the socket to the given address. This means it will be a server."""
+        if not self.is_bound:
+            self.socket.bind(address)
+            self.is_bound = True
+
+    def send_message(self, message: str | bytes, address: tuple[str, int]):
+        """Sends a message (JSON text or binary-encoded bytes) to the specified address."""
+        data = message.encode() if isinstance(message, str) else message
+        outbox = getattr(self.cork, "outbox", None)
+        if outbox is not None:
+            outbox.append((data, address))
+            return
+        self._sendto(data, address)
+
+    def _sendto(self, data, address):
+        while True:
+            try:
+                self.socket.sendto(data, address)
+                return
+            except BlockingIOError:
+                # non-blocking socket with a full send buffer: wait for room like a blocking one would
+                select.select((), (self.socket,), (), 1)
+
+    @contextlib.contextmanager
+    def corked(self):
+        """
+        Holds back the messages this thread sends inside the block; they go out back to back
+        when it ends (Python has no sendmmsg, so that is still one sendto each).
+        """
+        outbox = self.cork.outbox = []
+        try:
+            yield
+        finally:
+            self.cork.outbox = None
+            for data, address in outbox:
+                self._sendto(data, address)
+
+    def receive_batch(self):
+        """
+        Batched mode: returns [(data, address)] for every datagram already queued, up to RECV_BATCH,
+        read with recvfrom_into the preallocated buffers; sleeps (no timeout polling) until there is one.
+
+        JSON comes back as str; binary datagrams as memoryviews into the buffers, which are only
+        valid until the next call.
+        """
+        while True:
+            batch = []
+            for buf in self.buffers:
+                try:
+                    n, addr = self.socket.recvfrom_into(buf)
+                except BlockingIOError:
+                    break
+                except OSError as e:
+                    if e.errno == errno.ECONNRESET:
+                        print("Peer unreachable (ECONNRESET).")
+                        continue
+                    raise
+                data = buf[:n]
+                batch.append((data if BinaryCodec.is_binary(data) else str(data, "utf-8", "replace"), addr))
+            if batch:
+                return batch
+            self.selector.select()
+
+    def receive_message(self):
+        """
+        Receives a message from the socket, waiting as long as it takes.
+
+        Returns:
+            tuple (data, address): The received message and the address it came from.
+
+        An ECONNRESET (an earlier send hit a closed port) is reported and skipped;
+        other socket errors are raised.
+        """
+        while True:
+            try:
+                data, addr = self.socket.recvfrom(DATAGRAM_MAX)
+                return (data if BinaryCodec.is_binary(data) else data.decode(errors="replace")), addr
+            except socket.timeout:
+                continue
+            except OSError as e:
+                if e.errno == errno.ECONNRESET:
+                    print("Peer unreachable (ECONNRESET).")
+                    continue
+                raise
+
+    def close(self):
+        """Closes the UDP socket."""
+        if self.selector is not None:
+            self.selector.close()
+        self.socket.close()
@@ -0,0 +1,163 @@
+import json
+import struct
+
+# Largest batch datagram worth sending: keeps multi-question queries and their
+# answers under a typical Ethernet MTU, so they are never IP-fragmented.
+BATCH_BUDGET = 1400
+
+
+def split_batch(items: list, budget: int = BATCH_BUDGET, overhead: int = 64):
+    """
+    Splits the questions or answers of a batch message into runs that fit in one datagram each.
+
+    Sizes are measured as json.dumps() output; overhead is reserved for the rest of the
+    message (txid, flag, ...). An item too big for a datagram on its own still gets a run of its own.
+
+    Examples:
+    >>> items = [{"name": f"host{i}.amazone.com", "type": "A"} for i in range(100)]
+    >>> [len(run) for run in split_batch(items)]
+    [29, 29, 29, 13]
+    >>> split_batch([])
+    []
+    """
+    runs, run, size = [], [], overhead
+    for item in items:
+        item_size = len(json.dumps(item)) + 2  # ", " separator
+        if run and size + item_size > budget:
+            runs.append(run)
+            run, size = [], overhead
+        run.append(item)
+        size += item_size
+    if run:
+        runs.append(run)
+    return runs
+
+
+class BinaryCodec:
+    """
+    Packs DNS messages into a compact binary form, as an alternative to the JSON wire format.
+
+    Layout (network byte order), loosely modelled on the RFC 1035 header:
+
+        magic   B   0xD5, never '{', so a receiver can tell binary from JSON per datagram
+        txid    I
+        flags   B   high nibble: DNSTypes code, bits 1-2: rcode, bit 0: response
+        ttl     I   responses only
+        name    B length + UTF-8 bytes
+        result  H length + UTF-8 bytes, responses with rcode OK only
+
+    "Record not found" and "Server failure" travel as rcodes instead of strings.
+    Messages that do not fit this layout (unknown types, extra fields) are left to JSON:
+    encode() returns None for them.
+
+    Examples:
+    >>> codec = BinaryCodec({"A": 0b1000, "AAAA": 0b0100, "CNAME": 0b0010, "NS": 0b0001})
+    >>> query = {"txid": 7, "flag": "0000", "question": {"name": "shop.amazone.com", "type": "A"}}
+    >>> wire = codec.encode(query)
+    >>> len(wire), BinaryCodec.is_binary(wire)
+    (23, True)
+    >>> codec.decode(wire) == query
+    True
+    >>> codec.decode(codec.encode({"txid": 7, "flag": "0001",
+    ...     "answer": {"name": "x.com", "type": "NS", "ttl": 0, "result": "Record not found"}}))["answer"]
+    {'name': 'x.com', 'type': 'NS', 'ttl': 0, 'result': 'Record not found'}
+    """
+
+    MAGIC = 0xD5
+    HEADER = struct.Struct("!BIB")
+    TTL = struct.Struct("!I")
+    NAME_LEN = struct.Struct("!B")
+    RESULT_LEN = struct.Struct("!H")
+
+    RCODE_OK = 0
+    RCODE_NOT_FOUND = 1
+    RCODE_SERVFAIL = 2
+    rcode_to_result = {RCODE_NOT_FOUND: "Record not found", RCODE_SERVFAIL: "Server failure"}
+    result_to_rcode = {result: rcode for rcode, result in rcode_to_result.items()}
+
+    def __init__(self, name_to_code: dict):
+        """Takes the type name -> 4-bit code table, i.e. DNSTypes.name_to_code."""
+        self.name_to_code = name_to_code
+        self.code_to_name = {code: name for name, code in name_to_code.items()}
+
+    @staticmethod
+    def is_binary(data) -> bool:
+        """Whether a received datagram is in the binary format rather than JSON."""
+        return isinstance(data, (bytes, bytearray, memoryview)) and len(data) > 0 and data[0] == BinaryCodec.MAGIC
+
+    def encode(self, message: dict):
+        """Encodes a query or response dict, or returns None if it can only be sent as JSON."""
+        if not isinstance(message, dict):
+            return None
+        txid = message.get("txid")
+        if not isinstance(txid, int) or not 0 <= txid <= 0xFFFFFFFF:
+            return None
+        flag = message.get("flag")
+        if flag == "0000" and message.keys() == {"txid", "flag", "question"}:
+            body = message["question"]
+            response = False
+        elif flag == "0001" and message.keys() == {"txid", "flag", "answer"}:
+            body = message["answer"]
+            response = True
+        else:
+            return None
+        if not isinstance(body, dict):
+            return None
+        code = self.name_to_code.get(body.get("type"))
+        name = body.get("name")
+        if code is None or not isinstance(name, str):
+            return None
+        name_bytes = name.encode()
+        if len(name_bytes) > 0xFF:
+            return None
+
+        if not response:
+            flags = code << 4
+            return self.HEADER.pack(self.MAGIC, txid, flags) + self.NAME_LEN.pack(len(name_bytes)) + name_bytes
+
+        result = body.get("result")
+        ttl = body.get("ttl", 0)
+        if not isinstance(result, str) or not isinstance(ttl, int) or not 0 <= ttl <= 0xFFFFFFFF:
+            return None
+        rcode = self.result_to_rcode.get(result, self.RCODE_OK)
+        flags = code << 4 | rcode << 1 | 1
+        parts = [self.HEADER.pack(self.MAGIC, txid, flags), self.TTL.pack(ttl),
+                 self.NAME_LEN.pack(len(name_bytes)), name_bytes]
+        if rcode == self.RCODE_OK:
+            result_bytes = result.encode()
+            if len(result_bytes) > 0xFFFF:
+                return None
+            parts += [self.RESULT_LEN.pack(len(result_bytes)), result_bytes]
+        return b"".join(parts)
+
+    def decode(self, data):
+        """Decodes a binary datagram into the same dict shape as the JSON format, or None if malformed."""
+        try:
+            magic, txid, flags = self.HEADER.unpack_from(data, 0)
+            rtype = self.code_to_name.get(flags >> 4)
+            if magic != self.MAGIC or rtype is None:
+                return None
+            offset = self.HEADER.size
+            if not flags & 1:
+                name, offset = self.__unpack_str(data, offset, self.NAME_LEN)
+                return {"txid": txid, "flag": "0000", "question": {"name": name, "type": rtype}}
+
+            (ttl,) = self.TTL.unpack_from(data, offset)
+            name, offset = self.__unpack_str(data, offset + self.TTL.size, self.NAME_LEN)
+            rcode = flags >> 1 & 0b11
+            if rcode == self.RCODE_OK:
+                result, offset = self.__unpack_str(data, offset, self.RESULT_LEN)
+            else:
+                result = self.rcode_to_result.get(rcode, "Server failure")
+            return {"txid": txid, "flag": "0001", "answer": {"name": name, "type": rtype, "ttl": ttl, "result": result}}
+        except (struct.error, UnicodeDecodeError, ValueError):
+            return None
+
+    @staticmethod
+    def __unpack_str(data, offset, length_struct):
+        (length,) = length_struct.unpack_from(data, offset)
+        start = offset + length_struct.size
+        if start + length > len(data):
+            raise ValueError("truncated string")
+        # str() decodes straight out of a bytes object or a memoryview into a receive buffer
+        return str(data[start:start + length], "utf-8"), start + length
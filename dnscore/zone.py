@@ -0,0 +1,142 @@
+import array
+import mmap
+import os
+import struct
+
+
+class ZoneFile:
+    """
+    Authoritative records read from a zone file, served from a memory-mapped index.
+
+    The zone file is plain text, one record per line:
+
+        ; comment
+        shop.amazone.com    A      3.33.147.88
+        amazone.com         NS     dns.amazone.com    3600
+
+    The optional last column is the ttl; records without one are static.
+    The first time a zone is opened it is compiled into "<path>.idx", and it is
+    recompiled whenever the text file is newer. After that, opening a zone only
+    maps the index, so startup time does not grow with the zone.
+
+    Index layout: HEADER (magic, record count), then one native-order uint64
+    offset per record, sorted by (lower-cased name, upper-cased type). The records
+    follow, each stored as RECORD (name length, type length, ttl or -1, result length)
+    plus the UTF-8 name, type and result. A lookup binary-searches the offsets.
+    No Python object is built per record until that record is returned.
+
+    Examples:
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "test.zone")
+    >>> with open(path, "w") as f:
+    ...     _ = f.write("Shop.amazone.com A 3.33.147.88\\nshop.amazone.com A 3.33.147.89 60\\ncloud.amazone.com A 15.197.140.28\\n")
+    >>> zone = ZoneFile(path)
+    >>> len(zone)
+    3
+    >>> zone.lookup("SHOP.amazone.com", "a")
+    [('Shop.amazone.com', 'A', '3.33.147.88', None), ('shop.amazone.com', 'A', '3.33.147.89', 60)]
+    >>> zone.lookup("shop.amazone.com", "AAAA")
+    []
+    >>> zone.close()
+    """
+
+    MAGIC = b"ZONEIDX1"
+    HEADER = struct.Struct("!8sQ")
+    RECORD = struct.Struct("!BBiH")
+    NO_TTL = -1
+
+    def __init__(self, path: str):
+        """Opens the zone at path, (re)compiling its index first if that is missing or stale."""
+        self.path = path
+        index_path = path + ".idx"
+        if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(path):
+            with open(path, encoding="utf-8") as f:
+                self.compile(self.parse(f), index_path)
+        self.file = open(index_path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            self.close()
+            raise ValueError(f"{index_path} is not a zone index")
+        start = self.HEADER.size
+        self.offsets = memoryview(self.map)[start:start + 8 * self.count].cast("Q")
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def parse(lines):
+        """Yields (name, type, result, ttl) for every record line, skipping blanks and ; or # comments."""
+        for number, line in enumerate(lines, 1):
+            fields = line.split(";", 1)[0].split("#", 1)[0].split()
+            if not fields:
+                continue
+            if len(fields) not in (3, 4):
+                raise ValueError(f"line {number}: expected 'name type result [ttl]', got {line.strip()!r}")
+            yield fields[0], fields[1].upper(), fields[2], int(fields[3]) if len(fields) == 4 else None
+
+    @classmethod
+    def compile(cls, records, index_path: str):
+        """Writes the sorted index for (name, type, result, ttl) records; written to a temp file then renamed."""
+        encoded = []
+        for name, rtype, result, ttl in records:
+            name_b, type_b, result_b = name.encode(), rtype.encode(), result.encode()
+            if len(name_b) > 0xFF or len(type_b) > 0xFF or len(result_b) > 0xFFFF:
+                raise ValueError(f"record too long: {name} {rtype}")
+            encoded.append((name_b.lower(), type_b.upper(), name_b, type_b, result_b,
+                            cls.NO_TTL if ttl is None else ttl))
+        # stable, so several records for one (name, type) keep their file order
+        encoded.sort(key=lambda e: (e[0], e[1]))
+
+        offsets = array.array("Q")
+        position = cls.HEADER.size + 8 * len(encoded)
+        for _, _, name_b, type_b, result_b, _ in encoded:
+            offsets.append(position)
+            position += cls.RECORD.size + len(name_b) + len(type_b) + len(result_b)
+
+        tmp = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, len(encoded)))
+            f.write(offsets.tobytes())
+            for _, _, name_b, type_b, result_b, ttl in encoded:
+                f.write(cls.RECORD.pack(len(name_b), len(type_b), ttl, len(result_b)))
+                f.write(name_b + type_b + result_b)
+        os.replace(tmp, index_path)
+
+    def __key_at(self, i):
+        name_len, type_len, _, _ = self.RECORD.unpack_from(self.map, self.offsets[i])
+        start = self.offsets[i] + self.RECORD.size
+        return self.map[start:start + name_len].lower(), self.map[start + name_len:start + name_len + type_len].upper()
+
+    def __record_at(self, i):
+        name_len, type_len, ttl, result_len = self.RECORD.unpack_from(self.map, self.offsets[i])
+        start = self.offsets[i] + self.RECORD.size
+        name = self.map[start:start + name_len].decode()
+        rtype = self.map[start + name_len:start + name_len + type_len].decode()
+        start += name_len + type_len
+        result = self.map[start:start + result_len].decode()
+        return name, rtype, result, None if ttl == self.NO_TTL else ttl
+
+    def lookup(self, name: str, rtype: str):
+        """All (name, type, result, ttl) records for the pair, in zone file order; [] if there are none."""
+        key = (name.encode().lower(), rtype.encode().upper())
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.__key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        found = []
+        while lo < self.count and self.__key_at(lo) == key:
+            found.append(self.__record_at(lo))
+            lo += 1
+        return found
+
+    def close(self):
+        """Unmaps the index."""
+        if getattr(self, "offsets", None) is not None:
+            self.offsets.release()
+            self.offsets = None
+        self.map.close()
+        self.file.close()
@@ -1,98 +1,53 @@
-import errno
-import json
-import socket
+import argparse
+import asyncio
+import contextlib
+import heapq
+import multiprocessing
+import os
+import random
+import signal
 import sys
 import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from dnscore.metrics import Histogram, Rate
+from dnscore.protocol import (DATAGRAM_MAX, NOT_FOUND, REFUSED, SERVFAIL, STATS_FLAG, STATS_REPLY_FLAG, deserialize,
+                              fit, serialize)
+from dnscore.rrtable import EVICTION_POLICIES, RRTable
+from dnscore.tcp import FRAME_MAX, IDLE_TIMEOUT, StreamAddress, TCPListener, TCPPool, frame, unframe
+from dnscore.udp import UDPConnection
+from dnscore.wire import BinaryCodec, split_batch
+from ratelimit import RateLimiter
+from tablelog import TableLog
 
 # ---------- Config ----------
 LOCAL_BIND = ("127.0.0.1", 21000)
+# where amazone listens; queries go to the closest NS delegation's address on this port
 AMAZON_ADDR = ("127.0.0.1", 22000)
 DEFAULT_TTL = 60
-
-# ---------- Helpers ----------
-def serialize(message):
-    return json.dumps(message, separators=(",", ":"))
-
-def deserialize(wire):
-    try:
-        return json.loads(wire)
-    except json.JSONDecodeError:
-        return {}
-
-class DNSTypes:
-    name_to_code = {"A":0b1000,"AAAA":0b0100,"CNAME":0b0010,"NS":0b0001}
-    code_to_name = {v:k for k,v in name_to_code.items()}
-    @staticmethod
-    def get_type_name(code:int): return DNSTypes.code_to_name.get(code)
-    @staticmethod
-    def get_type_code(name:str): return DNSTypes.name_to_code.get(name)
-
-class UDPConnection:
-    def __init__(self, timeout:int=1):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.settimeout(timeout)
-        self.is_bound = False
-    def bind(self, address):
-        if not self.is_bound:
-            self.socket.bind(address); self.is_bound = True
-    def send_message(self, message:str, address:tuple[str,int]):
-        self.socket.sendto(message.encode(), address)
-    def receive_message(self):
-        while True:
-            try:
-                data, addr = self.socket.recvfrom(4096)
-                return data.decode(), addr
-            except socket.timeout:
-                continue
-            except OSError as e:
-                if e.errno == errno.ECONNRESET:
-                    print("Peer unreachable (ECONNRESET)."); continue
-                raise
-    def close(self): self.socket.close()
-
-class RRTable:
-    # record: {record_number,name,type,result,ttl,static}
-    def __init__(self):
-        self.records = []
-        self.record_number = 0
-        self.lock = threading.Lock()
-        t = threading.Thread(target=self.__decrement_ttl, daemon=True); t.start()
-    def add_record(self, name, rtype, result, ttl:int|None, is_static:bool):
-        with self.lock:
-            self.records.append({
-                "record_number": self.record_number,
-                "name": name,
-                "type": rtype,
-                "result": result,
-                "ttl": None if is_static else int(ttl or 0),
-                "static": 1 if is_static else 0
-            })
-            self.record_number += 1
-    def get_record(self, name, rtype):
-        with self.lock:
-            target = (name.lower(), rtype.upper())
-            for r in self.records:
-                if r["name"].lower()==target[0] and r["type"].upper()==target[1]:
-                    if r["static"]==1: return r
-                    if isinstance(r["ttl"],int) and r["ttl"]>0: return r
-            return None
-    def display_table(self):
-        with self.lock:
-            print("record_number,name,type,result,ttl,static")
-            for r in self.records:
-                ttl = "None" if r["ttl"] is None else r["ttl"]
-                print(f'{r["record_number"]},{r["name"]},{r["type"]},{r["result"]},{ttl},{r["static"]}')
-    def __decrement_ttl(self):
-        while True:
-            with self.lock:
-                for r in self.records:
-                    if r["static"]==0 and isinstance(r["ttl"],int) and r["ttl"]>0:
-                        r["ttl"] -= 1
-                self.records = [r for r in self.records if r["static"]==1 or (isinstance(r["ttl"],int) and r["ttl"]>0)]
-                for i,r in enumerate(self.records): r["record_number"]=i
-                self.record_number = len(self.records)
-            time.sleep(1)
+# upstream query retransmission: first retry after UPSTREAM_TIMEOUT seconds,
+# each further wait multiplied by UPSTREAM_BACKOFF. Every attempt adds up to
+# 0.4+0.8+1.6 = 2.8s, under client.py's 3s timeout, so clients hear SERVFAIL rather than nothing
+UPSTREAM_TIMEOUT = 0.4
+UPSTREAM_RETRIES = 2
+UPSTREAM_BACKOFF = 2.0
+PENDING_MAX = 10000
+# how long "Record not found" answers are cached; 0 disables negative caching
+NEGATIVE_TTL = 30
+# refresh-ahead: once a cached record has been hit PREFETCH_MIN_HITS times and has
+# less than PREFETCH_FRACTION of its ttl left, re-query it in the background (0 = off)
+PREFETCH_FRACTION = 0.1
+PREFETCH_MIN_HITS = 3
+DELEGATION_CACHE_MAX = 4096 # names whose upstream server is remembered
+# CNAME links followed for one question before giving up with SERVFAIL
+MAX_CNAME_CHAIN = 8
+SNAPSHOT_INTERVAL = 60      # seconds between cache snapshots when --snapshot is set
+# upstream queries leave from a random one of this many sockets, each on its own ephemeral port
+UPSTREAM_SOCKETS = 8
+# threads asking upstream again over TCP after a truncated reply (each holds one pooled connection)
+TCP_RETRY_WORKERS = 8
 
 # ---------- Authoritative seed for CSUSM ----------
 def seed_authoritative_csusm(rr: RRTable):
@@ -103,93 +58,891 @@ def seed_authoritative_csusm(rr: RRTable):
     # add more if your testcases expect them
 
 # ---------- Server logic ----------
+class PendingQuery:
+    # one query forwarded upstream for (name, type), shared by every client
+    # waiting on it; in asyncio mode `future` resolves to the reply.
+    # A refresh-ahead query starts with no client (prefetch=True).
+    __slots__ = ("name","rtype","waiters","future","attempts","prefetch","upstream","via","started","held")
+    def __init__(self, name, rtype, client=None, future=None, chain=()):
+        self.name = name
+        self.rtype = rtype
+        # [(client, chain)] to answer when the reply arrives; client is
+        # (client_addr, client_txid, binary), chain the CNAME links that led the
+        # client's question to this name (empty unless it was an alias)
+        self.waiters = [(client, chain)] if client is not None else []
+        self.prefetch = client is None
+        self.future = future
+        self.attempts = 0
+        # address of the nameserver the query is delegated to, set by _forward
+        self.upstream = None
+        # index of the upstream socket every copy goes out on (None: the client socket, or not sent yet);
+        # picked once, so a late reply to an earlier copy still arrives where it is expected
+        self.via = None
+        self.started = time.monotonic()
+        # set while the answer is fetched some other way (over TCP): no more retransmits or timeout
+        self.held = False
+    @property
+    def key(self): return RRTable.key(self.name, self.rtype)
+
+class BatchReply:
+    # the answers to one multi-question query, sent back together once the last
+    # is in. Each question is resolved with (batch, index) standing in for the
+    # usual (client_addr, client_txid, binary) client.
+    __slots__ = ("client","answers","missing","lock")
+    def __init__(self, client, size):
+        self.client = client
+        self.answers = [None] * size
+        self.missing = size
+        self.lock = threading.Lock()
+    def fill(self, index, answer):
+        # True once every answer is in
+        with self.lock:
+            if self.answers[index] is None:
+                self.answers[index] = answer
+                self.missing -= 1
+            return self.missing == 0
+
+class PendingTable:
+    # upstream_txid -> PendingQuery, plus the (name, type) -> txid map used to
+    # coalesce queries. Every entry has a deadline in a min-heap of
+    # (deadline, txid, attempt); when it passes, the entry is either sent
+    # again with a longer deadline or failed. The table never holds more than
+    # max_entries queries: adding past the cap evicts the oldest one.
+    def __init__(self, max_entries=PENDING_MAX, timeout=UPSTREAM_TIMEOUT,
+                 retries=UPSTREAM_RETRIES, backoff=UPSTREAM_BACKOFF):
+        self.entries = {}
+        self.inflight = {}
+        self.heap = []
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.cv = threading.Condition(self.lock)
+        # called with the lock held when a new earliest deadline is pushed
+        self.wake = self.cv.notify
+        self.stats = {"forwarded":0,"coalesced":0,"retransmits":0,"timeouts":0,"evictions":0}
+    def __len__(self): return len(self.entries)
+    @property
+    def budget(self):
+        # seconds from the first copy of a query until it is failed
+        return sum(self.timeout * self.backoff ** i for i in range(self.retries + 1))
+    def __contains__(self, txid): return txid in self.entries
+    def get(self, txid): return self.entries.get(txid)
+    def join(self, key, waiter):
+        # attach a (client, chain) waiter to the query already in flight for key, if any
+        with self.lock:
+            txid = self.inflight.get(key)
+            if txid is None: return False
+            self.entries[txid].waiters.append(waiter)
+            self.stats["coalesced"] += 1
+            return True
+    def add(self, txid, entry):
+        # returns the entry evicted to make room, if any
+        with self.lock:
+            evicted = None
+            if len(self.entries) >= self.max_entries:
+                evicted = self._remove(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+            self.entries[txid] = entry
+            self.inflight[entry.key] = txid
+            self.stats["forwarded"] += 1
+            self._schedule(txid, entry, time.monotonic())
+            return evicted
+    def pop(self, txid):
+        with self.lock:
+            return self._remove(txid)
+    def hold(self, txid):
+        # cancel txid's retransmits and timeout but keep it joinable; the entry, or None
+        # if it is already settled or held
+        with self.lock:
+            entry = self.entries.get(txid)
+            if entry is None or entry.held: return None
+            entry.held = True
+            return entry
+    def _remove(self, txid):
+        entry = self.entries.pop(txid, None)
+        if entry is not None and self.inflight.get(entry.key) == txid:
+            del self.inflight[entry.key]
+        return entry
+    def _schedule(self, txid, entry, now):
+        entry.attempts += 1
+        deadline = now + self.timeout * self.backoff ** (entry.attempts - 1)
+        heapq.heappush(self.heap, (deadline, txid, entry.attempts))
+        if self.heap[0][1] == txid: self.wake()
+    def next_deadline(self):
+        with self.lock:
+            return self.heap[0][0] if self.heap else None
+    def expire(self, now):
+        # -> ([(txid, entry)] to send again, [entry] that ran out of attempts)
+        with self.lock:
+            retransmit, failed = [], []
+            while self.heap and self.heap[0][0] <= now:
+                _, txid, attempt = heapq.heappop(self.heap)
+                entry = self.entries.get(txid)
+                if entry is None or entry.attempts != attempt or entry.held:
+                    continue  # answered, evicted, already rescheduled, or being fetched over TCP
+                if entry.attempts <= self.retries:
+                    self._schedule(txid, entry, now)
+                    self.stats["retransmits"] += 1
+                    retransmit.append((txid, entry))
+                else:
+                    failed.append(self._remove(txid))
+                    self.stats["timeouts"] += 1
+            # answered entries leave stale heap items behind; drop them once they dominate
+            if len(self.heap) > 4 * max(len(self.entries), 64):
+                self.heap = [h for h in self.heap if h[1] in self.entries and self.entries[h[1]].attempts == h[2]]
+                heapq.heapify(self.heap)
+            return retransmit, failed
+    def wait_due(self):
+        # threaded mode: block until some deadline passes, then expire()
+        while True:
+            with self.cv:
+                now = time.monotonic()
+                if not (self.heap and self.heap[0][0] <= now):
+                    self.cv.wait(self.heap[0][0] - now if self.heap else None)
+                    continue
+            retransmit, failed = self.expire(now)
+            if retransmit or failed: return retransmit, failed
+
 class LocalDNSServer:
-    def __init__(self):
-        self.rr = RRTable()
+    # serve_forever() drains sockets with UDPConnection.receive_batch
+    BATCHED_IO = True
+
+    def __init__(self, upstream_timeout=UPSTREAM_TIMEOUT, upstream_retries=UPSTREAM_RETRIES, max_pending=PENDING_MAX,
+                 negative_ttl=NEGATIVE_TTL, upstream_binary=False, reuse_port=False,
+                 cache_size=None, cache_policy="lru", prefetch_fraction=PREFETCH_FRACTION,
+                 prefetch_min_hits=PREFETCH_MIN_HITS, snapshot_path=None, snapshot_interval=SNAPSHOT_INTERVAL,
+                 zone_files=(), log_mode="table", dump_interval=0.0, upstream_sockets=UPSTREAM_SOCKETS,
+                 rate_limit=0, rate_burst=None, shed_backlog=0):
+        self.rr = RRTable(max_entries=cache_size, policy=cache_policy)
+        # per-query output and table dumps, written from their own thread
+        self.log = TableLog(self.rr.display_table, log_mode, dump_interval)
+        # warm restart: the previous run's cache, loaded lazily on first lookup
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        # in multi-process mode only one worker writes the (shared) snapshot file
+        self.snapshot_writer = True
+        if snapshot_path and os.path.exists(snapshot_path):
+            print(f"Loaded cache snapshot {snapshot_path}: {self.rr.load_snapshot(snapshot_path)} names")
+        # clients get answers in whichever format they asked in; this picks the upstream one
+        self.upstream_binary = upstream_binary
+        self.negative_ttl = negative_ttl
+        self.prefetch_fraction = prefetch_fraction
+        self.prefetch_min_hits = prefetch_min_hits
+        self.stats = {"queries": 0, "batches": 0, "negative_hits": 0, "prefetches": 0, "decode_errors": 0,
+                      # upstream replies thrown away: unknown txid, wrong source address or socket, wrong question
+                      "rejected_txid": 0, "rejected_source": 0, "rejected_question": 0,
+                      # queries over their client's rate limit (no reply) and ones refused while shedding load
+                      "dropped": 0, "refused": 0,
+                      # client replies too big for a datagram (sent truncated), upstream answers fetched again over TCP
+                      "truncated": 0, "tcp_retries": 0}
+        # admission control: queries per second per client address (0 = unlimited), and the number
+        # of outstanding upstream queries past which cache misses are refused rather than queued (0 = never)
+        self.limiter = RateLimiter(rate_limit, rate_burst)
+        self.shed_backlog = shed_backlog
+        # cheap enough to keep on: a few additions per query (see dnscore/metrics.py)
+        self.query_rate = Rate()
+        self.handle_latency = Histogram()
+        self.upstream_latency = Histogram()
+        self.started = time.monotonic()
+        self.worker_id = None
         seed_authoritative_csusm(self.rr)
-        self.conn = UDPConnection(timeout=1)
+        for path in zone_files:
+            print(f"Loaded zone {path}: {self.rr.load_zone(path)} records")
+        self.conn = UDPConnection(timeout=1, reuse_port=reuse_port, batched=self.BATCHED_IO)
         self.conn.bind(LOCAL_BIND)
-        self.next_txid = 0
-        # map upstream_txid -> (client_addr, client_txid)
-        self.pending = {}
+        # clients ask again over TCP, on the same port, when a reply comes back truncated
+        self.tcp_listener = TCPListener(LOCAL_BIND, reuse_port=reuse_port)
+        # a spoofed reply has to guess the socket's port as well as the txid. With SO_REUSEPORT
+        # replies to the shared port would hash to any worker, so workers always need their own
+        if reuse_port: upstream_sockets = max(1, upstream_sockets)
+        self.upstreams = []
+        for _ in range(upstream_sockets):
+            conn = UDPConnection(timeout=1, batched=self.BATCHED_IO)
+            conn.bind((LOCAL_BIND[0], 0))
+            self.upstreams.append(conn)
+        self.rng = random.SystemRandom()
+        # queues of sibling worker processes that records cached here are pushed to
+        self.cache_peers = []
+        # name -> (zone, nameserver address) for the closest delegation, valid for one trie version
+        self.delegation_cache = OrderedDict()
+        self.delegation_version = None
+        # CNAME chasing forwards from the upstream threads too, so guard the delegation cache
+        self.forward_lock = threading.Lock()
+        # per thread: upstream queries held back to go out as one batch (see _upstream_batch)
+        self.batching = threading.local()
+        # upstream_txid -> PendingQuery, with deadlines and a size cap
+        self.pending = PendingTable(max_entries=max_pending, timeout=upstream_timeout, retries=upstream_retries)
+        # truncated upstream answers are fetched again over persistent TCP connections, allowed
+        # as long as the UDP attempts would have had
+        self.upstream_tcp = TCPPool(timeout=self.pending.budget, max_idle=TCP_RETRY_WORKERS)
+        self.tcp_workers = ThreadPoolExecutor(TCP_RETRY_WORKERS, thread_name_prefix="tcp-retry")
 
     def _new_txid(self):
-        tx = self.next_txid & 0xFFFFFFFF
-        self.next_txid = (tx + 1) & 0xFFFFFFFF
-        return tx
+        # unpredictable, so an off-path spoofer can't aim at the next query
+        while True:
+            tx = self.rng.getrandbits(32)
+            if tx not in self.pending: return tx
+
+    def _pick_upstream(self):
+        return self.rng.randrange(len(self.upstreams)) if self.upstreams else None
 
-    def _answer(self, client_addr, client_txid, name, rtype, ttl, result):
+    def _send(self, message, addr, binary=False, via=None):
+        # via: index into self.upstreams, None for the client socket.
+        # A client that asked over TCP is answered on its connection, where a reply can be as big
+        # as a frame; a response too big for a datagram goes out truncated instead
+        stream = getattr(addr, "stream", None)
+        wire, cut = fit(message, binary, DATAGRAM_MAX if stream is None else FRAME_MAX)
+        if cut: self.stats["truncated"] += 1
+        if stream is None:
+            self._sendto(wire, addr, via)
+            return
+        try:
+            stream.send_message(wire)
+        except OSError:
+            pass  # the client has hung up
+
+    def _sendto(self, wire, addr, via=None):
+        conn = self.conn if via is None else self.upstreams[via]
+        conn.send_message(wire, addr)
+
+    def _reply(self, client, name, rtype, ttl, result, chain=()):
+        # client: (client_addr, client_txid, binary), answered in the format it asked in,
+        # or (BatchReply, index) for one question of a batch.
+        # With a CNAME chain, the answer is for the name the client asked about, good for
+        # as long as every link is, and the links travel alongside it in "chain".
+        if chain:
+            name = chain[0]["name"]
+            ttl = min([ttl, *(link["ttl"] for link in chain)])
+        answer = {"name": name, "type": rtype, "ttl": ttl, "result": result}
+        if isinstance(client[0], BatchReply):
+            batch, index = client
+            if chain: answer["chain"] = list(chain)
+            if batch.fill(index, answer): self._send_batch(batch)
+            return
+        client_addr, client_txid, binary = client
         resp = {
             "txid": client_txid,
             "flag": "0001",
-            "answer": {"name": name, "type": rtype, "ttl": ttl, "result": result}
+            "answer": answer
         }
-        self.conn.send_message(serialize(resp), client_addr)
-        self.rr.display_table()
+        if chain: resp["chain"] = list(chain)
+        self._send(resp, client_addr, binary)
+
+    def _send_batch(self, batch):
+        # answers in question order, split over as many datagrams as the size budget needs;
+        # "first" is the position of a datagram's first answer
+        client_addr, client_txid, binary = batch.client
+        first = 0
+        for run in split_batch(batch.answers) or [[]]:
+            self._send({"txid": client_txid, "flag": "0001", "first": first, "answers": run}, client_addr, binary)
+            first += len(run)
+
+    def _answer(self, client, name, rtype, ttl, result, chain=(), source="cache"):
+        # source: where the answer came from (auth, cache, upstream, timeout, loop, shed), for the query log
+        self._reply(client, name, rtype, ttl, result, chain)
+        addr = client[0].client[0] if isinstance(client[0], BatchReply) else client[0]
+        self.log.query(t=round(time.time(), 3), client=f"{addr[0]}:{addr[1]}", name=chain[0]["name"] if chain else name,
+                       type=rtype, result=result, ttl=ttl, source=source)
+
+    def save_snapshot(self):
+        if not self.snapshot_path or not self.snapshot_writer: return
+        try:
+            self.rr.save_snapshot(self.snapshot_path)
+        except OSError as e:
+            print(f"Cache snapshot not saved: {e}")
+
+    def _snapshot_periodically(self):
+        while True:
+            time.sleep(self.snapshot_interval)
+            self.save_snapshot()
+
+    def _start_snapshots(self):
+        if self.snapshot_path and self.snapshot_writer and self.snapshot_interval > 0:
+            threading.Thread(target=self._snapshot_periodically, daemon=True).start()
 
     def serve_forever(self):
+        self._start_snapshots()
+        threading.Thread(target=self._watch_pending, daemon=True).start()
+        for via, conn in enumerate(self.upstreams):
+            threading.Thread(target=self._serve_conn, args=(conn, via), daemon=True).start()
+        self.tcp_listener.serve(lambda wire, addr: self._dispatch(wire, addr, "tcp"))
         print(f"Local DNS listening on {LOCAL_BIND[0]}:{LOCAL_BIND[1]}")
+        self._serve_conn(self.conn)
+
+    def _serve_conn(self, conn, via=None):
         while True:
-            wire, addr = self.conn.receive_message()
-            msg = deserialize(wire)
-            if not isinstance(msg, dict): 
-                continue
-            flag = msg.get("flag")
-            if flag == "0000":
-                self._handle_query_from_client(msg, addr)
-            elif flag == "0001":
-                self._handle_response_from_amazon(msg)
-            # else ignore
-
-    def _handle_query_from_client(self, msg, client_addr):
-        client_txid = msg.get("txid")
-        q = msg.get("question", {})
-        name = q.get("name","")
-        rtype = q.get("type","A")
-
-        # 1) Authoritative check (CSUSM)
-        auth = self.rr.get_record(name, rtype)
-        if auth and auth["static"]==1:
-            self._answer(client_addr, client_txid, name, rtype, DEFAULT_TTL, auth["result"])
-            return
-
-        # 2) Cache check
-        if auth and auth["static"]==0:
-            ttl = auth["ttl"] if isinstance(auth["ttl"],int) else DEFAULT_TTL
-            self._answer(client_addr, client_txid, name, rtype, ttl, auth["result"])
-            return
-
-        # 3) Forward to Amazon authoritative
+            batch = conn.receive_batch()
+            # handle a whole burst before sending anything: its cache misses go upstream as
+            # one batch per nameserver, then the replies go out back to back
+            with self.conn.corked(), self._upstream_batch():
+                for wire, addr in batch:
+                    self._dispatch(wire, addr, via)
+
+    def _watch_pending(self):
+        while True:
+            self._on_pending_due(*self.pending.wait_due())
+
+    def _on_pending_due(self, retransmit, failed):
+        with self._upstream_batch():
+            for upstream_txid, entry in retransmit:
+                self._send_upstream(upstream_txid, entry)
+        for entry in failed:
+            self._settle(entry, None)
+
+    def _dispatch(self, wire, addr, via=None):
+        # via: which upstream socket the datagram arrived on, None for the client socket,
+        # "tcp" for a message on a client's TCP connection
+        start = time.perf_counter()
+        msg = deserialize(wire)
+        if not isinstance(msg, dict) or not msg:
+            self.stats["decode_errors"] += 1
+            return
+        flag = msg.get("flag")
+        if flag == "0000" and not self.limiter.allow(addr):
+            self.stats["dropped"] += 1
+        elif flag == "0000" and isinstance(msg.get("questions"), list):
+            self._handle_batch_from_client(msg, addr, BinaryCodec.is_binary(wire))
+        elif flag == "0000":
+            self._handle_query_from_client(msg, addr, BinaryCodec.is_binary(wire))
+        elif flag == "0001" and msg.get("tc") and isinstance(msg.get("questions"), list):
+            # a batch reply too big to send: each question is asked again on its own
+            for q in msg["questions"]:
+                if isinstance(q, dict):
+                    self._handle_response_from_amazon({"txid": q.get("txid"), "flag": "0001", "tc": 1, "question": q}, addr, via)
+        elif flag == "0001" and isinstance(msg.get("answers"), list):
+            # a batch reply: every answer echoes the txid of the question it belongs to
+            for ans in msg["answers"]:
+                if isinstance(ans, dict):
+                    self._handle_response_from_amazon({"txid": ans.get("txid"), "flag": "0001", "answer": ans}, addr, via)
+        elif flag == "0001":
+            self._handle_response_from_amazon(msg, addr, via)
+        elif flag == STATS_FLAG:
+            self._send({"txid": msg.get("txid"), "flag": STATS_REPLY_FLAG, "stats": self.stats_snapshot()}, addr)
+        # else ignore
+        self.handle_latency.observe(time.perf_counter() - start)
+
+    def stats_snapshot(self):
+        rr_stats, pending_stats = dict(self.rr.stats), dict(self.pending.stats)
+        looked_up = rr_stats["hits"] + rr_stats["misses"]
+        return {
+            "worker": self.worker_id,
+            "uptime_s": round(time.monotonic() - self.started, 1),
+            "qps_10s": self.query_rate.per_second(),
+            **self.stats,
+            "clients_tracked": len(self.limiter),
+            "log_dropped": self.log.dropped,
+            "cache": {**rr_stats, "hit_rate": round(rr_stats["hits"] / looked_up, 4) if looked_up else None,
+                      "records": len(self.rr.records), "lock_wait": self.rr.lock_waits.summary()},
+            "pending": {**pending_stats, "depth": len(self.pending.entries)},
+            "upstream_latency": self.upstream_latency.summary(),
+            "handle_latency": self.handle_latency.summary(),
+        }
+
+    def _handle_query_from_client(self, msg, client_addr, binary=False):
+        self.stats["queries"] += 1
+        self.query_rate.mark()
+        client = (client_addr, msg.get("txid"), binary)
+        self._resolve(client, *self._question(msg.get("question", {})))
+
+    def _handle_batch_from_client(self, msg, client_addr, binary=False):
+        questions = msg["questions"]
+        self.stats["batches"] += 1
+        self.stats["queries"] += len(questions)
+        self.query_rate.mark(len(questions))
+        batch = BatchReply((client_addr, msg.get("txid"), binary), len(questions))
+        if not questions:
+            self._send_batch(batch)
+            return
+        # whatever misses the cache goes upstream as batches too
+        with self._upstream_batch():
+            for index, q in enumerate(questions):
+                self._resolve((batch, index), *self._question(q))
+
+    def _question(self, q):
+        # (name, type) of a client's question; a malformed one is counted and asked as ("", "A"),
+        # which nothing answers, so the client still gets a reply in its place
+        if not isinstance(q, dict):
+            q = None
+        elif isinstance(q.get("name",""), str) and isinstance(q.get("type","A"), str):
+            return q.get("name",""), q.get("type","A")
+        self.stats["decode_errors"] += 1
+        return "", "A"
+
+    @contextlib.contextmanager
+    def _upstream_batch(self):
+        # hold back the upstream queries sent inside the block, then send them as
+        # one batch per nameserver (a lone query still goes out on its own)
+        if getattr(self.batching, "queries", None) is not None:
+            yield
+            return
+        self.batching.queries = []
+        try:
+            yield
+        finally:
+            queries, self.batching.queries = self.batching.queries, None
+            # retransmits keep the socket their query first left from, so they are grouped by it too
+            by_server = {}
+            for entry, question in queries:
+                by_server.setdefault((entry.upstream, entry.via), []).append((entry, question))
+            for (addr, via), pairs in by_server.items():
+                if len(pairs) == 1:
+                    entry, q = pairs[0]
+                    if entry.via is None: entry.via = self._pick_upstream()
+                    self._send({"txid": q["txid"], "flag": "0000", "question": {"name": q["name"], "type": q["type"]}},
+                               addr, self.upstream_binary, entry.via)
+                    continue
+                entries = dict((q["txid"], entry) for entry, q in pairs)
+                for run in split_batch([q for _, q in pairs]):
+                    # a batch leaves from one socket, so that is where all its answers must come back
+                    run_via = self._pick_upstream() if via is None else via
+                    for q in run: entries[q["txid"]].via = run_via
+                    self._send({"txid": run[0]["txid"], "flag": "0000", "questions": run}, addr, via=run_via)
+
+    @staticmethod
+    def _ttl_of(r):
+        # zone records may carry their own ttl; seeded ones get the default
+        return r.ttl if isinstance(r.ttl,int) else DEFAULT_TTL
+
+    def _resolve(self, client, name, rtype, chain=()):
+        # chain: CNAME links already followed from the client's question to name
+        while True:
+            if len(chain) > MAX_CNAME_CHAIN or any(link["name"].lower()==name.lower() for link in chain):
+                self._answer(client, name, rtype, 0, SERVFAIL, chain, source="loop")
+                return
+
+            # 1) Authoritative data (CSUSM, zones) or the cache, positive or negative
+            auth = self.rr.get_record(name, rtype)
+            if auth:
+                if auth.negative: self.stats["negative_hits"] += 1
+                self._answer(client, name, rtype, self._ttl_of(auth), auth.result, chain,
+                             source="auth" if auth.static else "cache")
+                if not auth.static: self._maybe_prefetch(auth)
+                return
+
+            # 2) An alias we already know: follow it without asking anyone
+            if rtype == "CNAME": break
+            alias = next((r for r in self.rr.get_records(name, "CNAME") if not r.negative), None)
+            if alias is None: break
+            chain = (*chain, {"name": alias.name, "type": "CNAME", "ttl": self._ttl_of(alias), "result": alias.result})
+            name = alias.result
+
+        # 3) Join an upstream query already in flight for the same (name, type)
+        if self.pending.join(RRTable.key(name, rtype), (client, chain)):
+            return
+
+        # 4) Forward to the closest delegated authoritative server, unless the backlog is
+        # already so long that the answer would come too late to matter
+        if self._overloaded():
+            self.stats["refused"] += 1
+            self._answer(client, name, rtype, 0, REFUSED, chain, source="shed")
+            return
+        self._forward(PendingQuery(name, rtype, client, chain=chain))
+
+    def _overloaded(self):
+        return 0 < self.shed_backlog <= len(self.pending)
+
+    def _maybe_prefetch(self, r):
+        # refresh a hot record before it expires so the next client doesn't miss
+        if (self.prefetch_fraction <= 0 or r.prefetching or r.hits < self.prefetch_min_hits
+                or r.ttl > r.orig_ttl * self.prefetch_fraction):
+            return
+        r.prefetching = True
+        key = RRTable.key(r.name, r.type)
+        if key in self.pending.inflight or self._overloaded():
+            return
+        self.stats["prefetches"] += 1
+        self._forward(PendingQuery(r.name, r.type))
+
+    def _delegation_for(self, name):
+        # (zone, addr) of the closest delegated nameserver; zone is None when nothing
+        # is delegated for name, addr is None when the nameserver has no known address
+        with self.forward_lock:
+            version = self.rr.delegations.version
+            if version != self.delegation_version:
+                self.delegation_cache.clear()
+                self.delegation_version = version
+            key = name.lower()
+            hit = self.delegation_cache.get(key)
+            if hit is not None:
+                self.delegation_cache.move_to_end(key)
+                return hit
+            found, addr = self.rr.delegation(name), None
+            if found is not None:
+                for host in found[1]:
+                    glue = next((r for r in self.rr.get_records(host, "A") if not r.negative), None)
+                    if glue is not None:
+                        # every server in this setup is on the host named by its glue record, at AMAZON_ADDR's port
+                        addr = (glue.result, AMAZON_ADDR[1])
+                        break
+            hit = (found[0] if found else None, addr)
+            self.delegation_cache[key] = hit
+            if len(self.delegation_cache) > DELEGATION_CACHE_MAX:
+                self.delegation_cache.popitem(last=False)
+            return hit
+
+    def _forward(self, entry):
+        zone, entry.upstream = self._delegation_for(entry.name)
+        if entry.upstream is None:
+            # not delegated anywhere: nobody upstream has it, so say so without asking;
+            # delegated to a nameserver with no address: nobody can be asked
+            self._settle(entry, {"answer": {"result": NOT_FOUND}} if zone is None else None)
+            return
         upstream_txid = self._new_txid()
-        self.pending[upstream_txid] = (client_addr, client_txid, name, rtype)
-        fwd = {"txid": upstream_txid, "flag":"0000", "question":{"name":name,"type":rtype}}
-        self.conn.send_message(serialize(fwd), AMAZON_ADDR)
+        evicted = self.pending.add(upstream_txid, entry)
+        if evicted is not None:
+            self._settle(evicted, None)
+        self._send_upstream(upstream_txid, entry)
+
+    def _send_upstream(self, upstream_txid, entry):
+        queries = getattr(self.batching, "queries", None)
+        if queries is not None:
+            # inside _upstream_batch: each question carries its own txid for the reply to echo
+            queries.append((entry, {"name": entry.name, "type": entry.rtype, "txid": upstream_txid}))
+            return
+        # a fresh socket for every query; its retransmits reuse it
+        if entry.via is None: entry.via = self._pick_upstream()
+        fwd = {"txid": upstream_txid, "flag":"0000", "question":{"name":entry.name,"type":entry.rtype}}
+        self._send(fwd, entry.upstream, self.upstream_binary, entry.via)
 
-    def _handle_response_from_amazon(self, msg):
+    def _handle_response_from_amazon(self, msg, addr=None, via=None):
+        # accept a reply only if it answers a query in flight, comes from the nameserver that
+        # query went to, arrived on the socket it left from, and is about the name asked;
+        # each check is a dict lookup or a comparison, so a flood of forgeries stays cheap
         upstream_txid = msg.get("txid")
-        if upstream_txid not in self.pending:
+        entry = self.pending.get(upstream_txid) if isinstance(upstream_txid, int) else None
+        if entry is None:
+            self.stats["rejected_txid"] += 1
+            return
+        if addr != entry.upstream or via != entry.via:
+            self.stats["rejected_source"] += 1
+            return
+        # a truncated reply carries the question instead of the answer
+        if not self._answers(entry, msg.get("question" if msg.get("tc") else "answer")):
+            self.stats["rejected_question"] += 1
+            return
+        if msg.get("tc"):
+            # the answer didn't fit in a datagram: ask the same nameserver again over TCP. The query
+            # stays in flight meanwhile, so clients missing on the same name join it rather than
+            # each starting a retry of their own
+            if self.pending.hold(upstream_txid) is None:
+                return  # settled, or a copy's truncated reply already started the retry
+            self.stats["tcp_retries"] += 1
+            self._retry_tcp(upstream_txid, entry)
+            return
+        entry = self.pending.pop(upstream_txid)
+        if entry is None:
+            # another thread settled it in the meantime
+            return
+        self.upstream_latency.observe(time.monotonic() - entry.started)
+        self._settle(entry, msg)
+
+    @staticmethod
+    def _answers(entry, ans):
+        # whether an upstream answer (or the question of a truncated one) is about entry's question
+        ans = ans if isinstance(ans, dict) else {}
+        name, rtype = ans.get("name"), ans.get("type")
+        return (isinstance(name, str) and isinstance(rtype, str) and name.lower() == entry.name.lower()
+                and rtype.upper() in (entry.rtype.upper(), "CNAME"))
+
+    def _retry_tcp(self, upstream_txid, entry):
+        self.tcp_workers.submit(lambda: self._settle_tcp(upstream_txid, self._exchange_tcp(upstream_txid, entry)))
+
+    def _settle_tcp(self, upstream_txid, msg):
+        # the held query leaves the pending table only now, unless eviction got to it first
+        entry = self.pending.pop(upstream_txid)
+        if entry is not None: self._settle(entry, msg)
+
+    def _exchange_tcp(self, upstream_txid, entry):
+        # blocking: the nameserver's reply to entry's question over a pooled TCP connection, or None
+        query = serialize({"txid": upstream_txid, "flag": "0000", "question": {"name": entry.name, "type": entry.rtype}},
+                          self.upstream_binary)
+        replies = []
+        def take(wire):
+            msg = deserialize(wire)
+            if not isinstance(msg, dict) or msg.get("txid") != upstream_txid: return False
+            replies.append(msg)
+            return True
+        if not self.upstream_tcp.exchange(query, entry.upstream, take): return None
+        msg = replies[0]
+        if msg.get("tc") or not self._answers(entry, msg.get("answer")): return None
+        self.upstream_latency.observe(time.monotonic() - entry.started)
+        return msg
+
+    def _settle(self, entry, msg):
+        # msg is None when upstream never answered (timed out or evicted)
+        if entry.future is not None:
+            # asyncio mode: hand the reply to the coroutine awaiting it
+            if not entry.future.done(): entry.future.set_result(msg)
+            return
+        self._complete(entry, msg)
+
+    def _complete(self, entry, msg):
+        if msg is None:
+            for client, chain in entry.waiters:
+                self._answer(client, entry.name, entry.rtype, 0, SERVFAIL, chain, source="timeout")
             return
-        client_addr, client_txid, name, rtype = self.pending.pop(upstream_txid)
 
         ans = msg.get("answer", {})
-        result = ans.get("result","Record not found")
+        result = ans.get("result",NOT_FOUND)
         ttl = ans.get("ttl", DEFAULT_TTL)
 
-        # cache only valid results
-        if result != "Record not found":
-            self.rr.add_record(name=name, rtype=rtype, result=result, ttl=int(ttl), is_static=False)
+        if ans.get("type","").upper() == "CNAME" and entry.rtype.upper() != "CNAME" and result not in (NOT_FOUND, SERVFAIL):
+            # the name is an alias: cache the link and carry on from its target for every waiter
+            self._cache(entry.name, "CNAME", result, int(ttl), replace=entry.prefetch)
+            link = {"name": entry.name, "type": "CNAME", "ttl": int(ttl), "result": result}
+            for client, chain in entry.waiters:
+                self._resolve(client, result, entry.rtype, (*chain, link))
+            return
 
-        # forward to original client with their txid
-        self._answer(client_addr, client_txid, name, rtype, ttl, result)
+        if result == NOT_FOUND:
+            # negative answer: cache it for negative_ttl and tell clients the same ttl
+            ttl = self.negative_ttl
+            if ttl > 0:
+                self._cache(entry.name, entry.rtype, result, ttl, is_negative=True, replace=entry.prefetch)
+        elif result not in (SERVFAIL, REFUSED):
+            self._cache(entry.name, entry.rtype, result, int(ttl), replace=entry.prefetch)
+
+        # forward to every waiting client with their own txid
+        for client, chain in entry.waiters:
+            self._answer(client, entry.name, entry.rtype, ttl, result, chain, source="upstream")
+
+    def _cache(self, name, rtype, result, ttl, is_negative=False, replace=False):
+        expires = time.monotonic() + ttl
+        self.rr.add_record(name, rtype, result, ttl, is_static=False, is_negative=is_negative, expires=expires,
+                           replace=replace)
+        # CLOCK_MONOTONIC is system-wide, so the deadline means the same thing in every worker
+        for q in self.cache_peers:
+            q.put((name, rtype, result, expires, is_negative))
+
+    def _apply_peer_records(self, inbox):
+        # records other workers resolved; skip ones this worker already has a fresher copy of
+        while True:
+            name, rtype, result, expires, is_negative = inbox.get()
+            have = next(iter(self.rr.get_records(name, rtype)), None)
+            if have is None or (not have.static and have.expires < expires):
+                self.rr.add_record(name, rtype, result, None, is_static=False, is_negative=is_negative, expires=expires,
+                                   replace=have is not None)
+
+# ---------- asyncio serving mode ----------
+class LocalDNSProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server, via=None):
+        self.server = server
+        # index of the upstream socket served, None for the client socket
+        self.via = via
+    def connection_made(self, transport):
+        if self.via is None:
+            self.server.transport = transport
+        else:
+            self.server.upstream_transports[self.via] = transport
+    def datagram_received(self, data, addr):
+        self.server._dispatch(data if BinaryCodec.is_binary(data) else data.decode(errors="replace"), addr, self.via)
+    def error_received(self, exc):
+        # e.g. ECONNRESET after sending to a closed port; keep serving
+        print(f"Socket error: {exc}")
+
+class LocalDNSStreamProtocol(asyncio.Protocol):
+    # one client's TCP connection: length-prefixed queries in, replies out the same way.
+    # It is also the stream its StreamAddress carries, so _send finds its way back here
+    def __init__(self, server):
+        self.server = server
+        self.buffer = bytearray()
+        self.transport = None
+        self.peer = None
+        self.idle = None
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = StreamAddress(transport.get_extra_info("peername"), self)
+        self._touch()
+    def data_received(self, data):
+        self.buffer += data
+        for wire in unframe(self.buffer):
+            self.server._dispatch(wire, self.peer, "tcp")
+        self._touch()
+    def connection_lost(self, exc):
+        if self.idle is not None: self.idle.cancel()
+    def _touch(self):
+        # hang up on a client that has been quiet for IDLE_TIMEOUT
+        if self.idle is not None: self.idle.cancel()
+        self.idle = asyncio.get_running_loop().call_later(IDLE_TIMEOUT, self.transport.close)
+    def send_message(self, wire):
+        if not self.transport.is_closing(): self.transport.write(frame(wire))
+
+class AsyncLocalDNSServer(LocalDNSServer):
+    # Same lookups and wire format as LocalDNSServer, but each forwarded
+    # query is a coroutine awaiting the future stored in its pending entry,
+    # so any number of them can wait on upstream while clients keep being served.
+    # The event loop does its own non-blocking reads, so the sockets are plain ones.
+    BATCHED_IO = False
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.transport = None
+        self.upstream_transports = [None] * len(self.upstreams)
+        self.loop = None
+        self.pending_changed = None
+
+    def _sendto(self, wire, addr, via=None):
+        transport = self.transport if via is None else self.upstream_transports[via]
+        transport.sendto(wire.encode() if isinstance(wire, str) else wire, addr)
+
+    def _retry_tcp(self, upstream_txid, entry):
+        # the pooled exchange blocks, so it runs on the retry threads; the reply is settled back on the loop
+        done = self.loop.run_in_executor(self.tcp_workers, self._exchange_tcp, upstream_txid, entry)
+        done.add_done_callback(lambda f: self._settle_tcp(upstream_txid, f.result()))
+
+    def _forward(self, entry):
+        entry.future = self.loop.create_future()
+        super()._forward(entry)
+        self.loop.create_task(self._await_upstream(entry))
+
+    async def _await_upstream(self, entry):
+        msg = await entry.future
+        self._complete(entry, msg)
+
+    async def _watch_pending_async(self):
+        while True:
+            deadline = self.pending.next_deadline()
+            delay = None if deadline is None else max(0, deadline - time.monotonic())
+            self.pending_changed.clear()
+            try:
+                await asyncio.wait_for(self.pending_changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self._on_pending_due(*self.pending.expire(time.monotonic()))
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.pending_changed = asyncio.Event()
+        self.pending.wake = self.pending_changed.set
+        transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: LocalDNSProtocol(self), sock=self.conn.socket)
+        for via, conn in enumerate(self.upstreams):
+            await self.loop.create_datagram_endpoint(
+                lambda via=via: LocalDNSProtocol(self, via), sock=conn.socket)
+        tcp_server = await self.loop.create_server(lambda: LocalDNSStreamProtocol(self), sock=self.tcp_listener.socket)
+        watcher = self.loop.create_task(self._watch_pending_async())
+        self._start_snapshots()
+        print(f"Local DNS (asyncio) listening on {LOCAL_BIND[0]}:{LOCAL_BIND[1]}")
+        stopped = self.loop.create_future()
+        # end serve() on SIGTERM rather than raising SystemExit inside whichever callback is running
+        self.loop.add_signal_handler(signal.SIGTERM, lambda: stopped.done() or stopped.set_result(None))
+        try:
+            await stopped
+        finally:
+            watcher.cancel()
+            tcp_server.close()
+            for t in self.upstream_transports: t.close()
+            transport.close()
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+# ---------- multi-process mode ----------
+# Each worker is a full LocalDNSServer bound to LOCAL_BIND with SO_REUSEPORT.
+# Lookups stay in the worker's own RRTable; whenever a worker caches an
+# upstream answer it pushes the record to every sibling's inbox queue, so a
+# name resolved by one worker is served from cache by all of them.
+def _run_worker(worker_id, inboxes, cls, kwargs):
+    srv = cls(reuse_port=True, **kwargs)
+    srv.cache_peers = [q for i,q in enumerate(inboxes) if i != worker_id]
+    # caches are replicated, so worker 0's snapshot covers everyone
+    srv.snapshot_writer = worker_id == 0
+    srv.worker_id = worker_id
+    signal.signal(signal.SIGUSR1, lambda *_: srv.log.dump())
+    threading.Thread(target=srv._apply_peer_records, args=(inboxes[worker_id],), daemon=True).start()
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srv.save_snapshot()
+        srv.conn.close()
+        srv.tcp_listener.close()
+
+def serve_workers(workers, cls=LocalDNSServer, kwargs=None):
+    ctx = multiprocessing.get_context("fork")
+    inboxes = [ctx.Queue() for _ in range(workers)]
+    procs = [ctx.Process(target=_run_worker, args=(i, inboxes, cls, kwargs or {}),
+                         name=f"localdns-worker-{i}", daemon=True) for i in range(workers)]
+    # make `kill <parent>` take the workers down too instead of orphaning them
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    for p in procs: p.start()
+    # `kill -USR1 <parent>` dumps every worker's table
+    signal.signal(signal.SIGUSR1, lambda *_: [os.kill(p.pid, signal.SIGUSR1) for p in procs if p.pid])
+    print(f"Local DNS started {workers} workers on {LOCAL_BIND[0]}:{LOCAL_BIND[1]}")
+    try:
+        for p in procs: p.join()
+    finally:
+        for p in procs:
+            if p.is_alive(): p.terminate()
 
 def main():
-    srv = LocalDNSServer()
+    global LOCAL_BIND, AMAZON_ADDR
+    parser = argparse.ArgumentParser(description="Local DNS server")
+    parser.add_argument("--port", type=int, default=LOCAL_BIND[1], help="UDP and TCP port to serve clients on")
+    parser.add_argument("--upstream-port", type=int, default=AMAZON_ADDR[1], help="UDP and TCP port of the amazone server (and any other delegated nameserver)")
+    parser.add_argument("--asyncio", action="store_true", help="serve with an asyncio DatagramProtocol")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes sharing the port via SO_REUSEPORT")
+    parser.add_argument("--upstream-timeout", type=float, default=UPSTREAM_TIMEOUT, help="seconds before the first retransmit (each later wait is twice as long)")
+    parser.add_argument("--retries", type=int, default=UPSTREAM_RETRIES, help="upstream retransmits before SERVFAIL")
+    parser.add_argument("--max-pending", type=int, default=PENDING_MAX, help="cap on outstanding upstream queries")
+    parser.add_argument("--upstream-sockets", type=int, default=UPSTREAM_SOCKETS,
+                        help="sockets upstream queries are spread over at random (0 = reuse the client socket; at least 1 with --workers)")
+    parser.add_argument("--upstream-wire", choices=("json","binary"), default="json", help="wire format for queries to amazone")
+    parser.add_argument("--cache-size", type=int, default=None, help="max cached (non-static) records, unbounded if unset")
+    parser.add_argument("--cache-policy", choices=sorted(EVICTION_POLICIES), default="lru", help="what to evict when the cache is full")
+    parser.add_argument("--prefetch-fraction", type=float, default=PREFETCH_FRACTION,
+                        help="refresh hot records with less than this fraction of their ttl left (0 = off)")
+    parser.add_argument("--prefetch-min-hits", type=int, default=PREFETCH_MIN_HITS, help="hits before a record counts as hot")
+    parser.add_argument("--negative-ttl", type=int, default=NEGATIVE_TTL, help="seconds to cache 'Record not found' (0 = off)")
+    parser.add_argument("--zone", metavar="PATH", action="append", default=[],
+                        help="serve the records in this zone file authoritatively (repeatable)")
+    parser.add_argument("--log", choices=TableLog.MODES, default="table",
+                        help="per query: dump the whole table, print one JSON line, or nothing (SIGUSR1 always dumps)")
+    parser.add_argument("--dump-interval", type=float, default=0.0, help="least seconds between two table dumps")
+    parser.add_argument("--rate-limit", type=float, default=0, help="queries per second allowed per client address (0 = unlimited)")
+    parser.add_argument("--rate-burst", type=float, default=None, help="queries a client may send at once (default: one second's worth)")
+    parser.add_argument("--shed-backlog", type=int, default=0,
+                        help="refuse cache misses while this many upstream queries are outstanding (0 = never)")
+    parser.add_argument("--snapshot", metavar="PATH", help="save the cache here periodically and on exit, and warm-start from it")
+    parser.add_argument("--snapshot-interval", type=float, default=SNAPSHOT_INTERVAL, help="seconds between snapshots (0 = only on exit)")
+    args = parser.parse_args()
+
+    LOCAL_BIND = (LOCAL_BIND[0], args.port)
+    AMAZON_ADDR = (AMAZON_ADDR[0], args.upstream_port)
+
+    cls = AsyncLocalDNSServer if args.asyncio else LocalDNSServer
+    kwargs = dict(upstream_timeout=args.upstream_timeout, upstream_retries=args.retries, max_pending=args.max_pending,
+                  negative_ttl=args.negative_ttl, upstream_binary=args.upstream_wire == "binary",
+                  cache_size=args.cache_size, cache_policy=args.cache_policy,
+                  prefetch_fraction=args.prefetch_fraction, prefetch_min_hits=args.prefetch_min_hits,
+                  snapshot_path=args.snapshot, snapshot_interval=args.snapshot_interval,
+                  zone_files=args.zone, log_mode=args.log, dump_interval=args.dump_interval,
+                  upstream_sockets=args.upstream_sockets, rate_limit=args.rate_limit, rate_burst=args.rate_burst,
+                  shed_backlog=args.shed_backlog)
+    if args.workers > 1:
+        # build any stale zone index once here rather than in every worker
+        from dnscore.zone import ZoneFile
+        for path in args.zone: ZoneFile(path).close()
+        try:
+            serve_workers(args.workers, cls, kwargs)
+        except KeyboardInterrupt:
+            print("Keyboard interrupt received, exiting...")
+        return
+
+    srv = cls(**kwargs)
+    signal.signal(signal.SIGUSR1, lambda *_: srv.log.dump())
+    # exit through the finally below on `kill` too, so the snapshot gets written
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
     try:
         srv.serve_forever()
     except KeyboardInterrupt:
         print("Keyboard interrupt received, exiting...")
     finally:
+        srv.save_snapshot()
         srv.conn.close()
+        srv.tcp_listener.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
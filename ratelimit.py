@@ -0,0 +1,66 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class RateLimiter:
+    """
+    Token bucket per client address: each client may send `rate` queries per second
+    on average and up to `burst` at once.
+
+    Buckets live in an OrderedDict kept in last-seen order. A bucket left alone for
+    burst / rate seconds has refilled completely, which is the same as having none,
+    so allow() drops such buckets from the old end as it goes. The table never holds
+    more than max_clients buckets; past that the least recently seen one is dropped.
+    Each call is O(1) amortized.
+
+    The key is the whole (host, port) address, so clients sharing a host (as everything
+    on 127.0.0.1 does here) get a bucket each. allow() takes a lock, since the servers call
+    it from every thread that receives queries. A rate of 0 or less lets everything through
+    without locking.
+
+    Example:
+    >>> limiter = RateLimiter(rate=2, burst=3, max_clients=2)
+    >>> [limiter.allow(("10.0.0.1", 53), now=0.0) for _ in range(4)]
+    [True, True, True, False]
+    >>> limiter.allow(("10.0.0.1", 53), now=0.5), limiter.allow(("10.0.0.1", 53), now=0.5)
+    (True, False)
+    >>> limiter.allow(("10.0.0.2", 53), now=0.5), limiter.allow(("10.0.0.3", 53), now=0.5), len(limiter)
+    (True, True, 2)
+    >>> limiter.allow(("10.0.0.3", 53), now=10.0), len(limiter)
+    (True, 1)
+    """
+
+    def __init__(self, rate: float, burst: float | None = None, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = burst if burst else max(rate, 1)
+        self.max_clients = max(1, max_clients)
+        # seconds for an empty bucket to fill up again
+        self.refill = self.burst / rate if rate > 0 else 0.0
+        # address -> [tokens, time of the last query]
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def allow(self, addr, now: float | None = None):
+        """Takes a token from addr's bucket; False if it is empty and the query should be dropped."""
+        if self.rate <= 0:
+            return True
+        now = time.monotonic() if now is None else now
+        buckets = self.buckets
+        with self.lock:
+            bucket = buckets.get(addr)
+            if bucket is None:
+                bucket = buckets[addr] = [self.burst, now]
+            else:
+                buckets.move_to_end(addr)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            while len(buckets) > self.max_clients or now - next(iter(buckets.values()))[1] >= self.refill:
+                buckets.popitem(last=False)
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
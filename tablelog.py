@@ -0,0 +1,132 @@
+import json
+import queue
+import sys
+import threading
+import time
+
+# query lines waiting for the writer; past this, new ones are dropped (and counted) rather than queued
+MAX_QUEUED = 10000
+
+
+class TableLog:
+    """
+    What a server prints about the queries it handles, written from a background thread
+    so a request handler never waits on stdout.
+
+    Modes:
+        table   dump the whole RR table after each query (the original behaviour). Dumps
+                that are requested while one is running are merged into one, and no two
+                dumps are closer together than `interval` seconds.
+        query   one JSON line per query; the table is dumped only when dump() is called,
+                e.g. from a SIGUSR1 handler.
+        off     nothing per query; dump() still works.
+
+    display is the table's display_table. It should copy the rows under the table's lock
+    and print after releasing it, so a slow terminal never holds up lookups.
+
+    If stdout falls behind, at most max_queued query lines wait for it; the rest are
+    dropped and counted in `dropped`, so a slow pipe costs log lines rather than memory.
+
+    Example:
+    >>> log = TableLog(lambda: print("<table>"), mode="query")
+    >>> log.query(name="shop.amazone.com", type="A", result="3.33.147.88", source="cache")
+    >>> log.flush()
+    {"name": "shop.amazone.com", "type": "A", "result": "3.33.147.88", "source": "cache"}
+    >>> log.dump(); log.flush()
+    <table>
+    >>> full = TableLog(print, mode="query", max_queued=0)
+    >>> full.query(name="x"); full.dropped
+    1
+    """
+
+    MODES = ("table", "query", "off")
+
+    def __init__(self, display, mode: str = "table", interval: float = 0.0, max_queued: int = MAX_QUEUED):
+        if mode not in self.MODES:
+            raise ValueError(f"unknown log mode {mode!r}")
+        self.display = display
+        self.mode = mode
+        self.interval = interval
+        # per-query fields to print, bounded; max_queued of 0 or less keeps none
+        self.items = queue.Queue(maxsize=max_queued) if max_queued > 0 else None
+        self.dropped = 0
+        # wakes the writer. A SimpleQueue, because dump() may run in a signal handler, which
+        # must not wait on a lock the interrupted thread holds (as Queue.put can)
+        self.wake = queue.SimpleQueue()
+        # set while the writer waits for a wake, so query() only sends one when it's needed
+        self.sleeping = False
+        self.dump_wanted = False
+        self.last_dump = float("-inf")
+        self.idle = threading.Event()
+        threading.Thread(target=self.__write, name="table-log", daemon=True).start()
+
+    def query(self, **fields):
+        """Logs one handled query; never blocks."""
+        if self.mode == "query":
+            try:
+                if self.items is None:
+                    raise queue.Full
+                self.items.put_nowait(fields)
+            except queue.Full:
+                self.dropped += 1
+                return
+            if self.sleeping:
+                self.sleeping = False
+                self.wake.put(None)
+        elif self.mode == "table":
+            self.dump()
+
+    def dump(self):
+        """Asks for a table dump; safe to call from a signal handler."""
+        # one wake per pending dump: the writer clears dump_wanted before it dumps,
+        # so a request made while this flag is still set is covered by that dump
+        if not self.dump_wanted:
+            self.dump_wanted = True
+            self.wake.put(None)
+
+    def flush(self, timeout: float = 1.0):
+        """Waits until everything logged so far has been written (for tests and shutdown)."""
+        self.idle.clear()
+        self.wake.put(None)
+        self.idle.wait(timeout)
+
+    def __write(self):
+        while True:
+            timeout = None
+            if self.dump_wanted:
+                timeout = max(0.0, self.last_dump + self.interval - time.monotonic())
+            # announce the wait before checking for lines, so a query() that queues one
+            # after the check sees the flag and wakes us
+            self.sleeping = True
+            if self.items is None or self.items.empty():
+                try:
+                    self.wake.get(timeout=timeout)
+                except queue.Empty:
+                    pass
+            self.sleeping = False
+            try:
+                while True:
+                    self.wake.get_nowait()
+            except queue.Empty:
+                pass
+            batch = []
+            try:
+                while self.items is not None:
+                    batch.append(self.items.get_nowait())
+            except queue.Empty:
+                pass
+
+            lines = [json.dumps(fields) for fields in batch]
+            if lines:
+                sys.stdout.write("\n".join(lines) + "\n")
+                sys.stdout.flush()
+            if self.dump_wanted and time.monotonic() - self.last_dump >= self.interval:
+                self.dump_wanted = False
+                self.last_dump = time.monotonic()
+                try:
+                    self.display()
+                except Exception as e:  # a broken dump must not take the writer thread down
+                    print(f"Table dump failed: {e}")
+                sys.stdout.flush()
+            if self.items is None or self.items.empty():
+                self.idle.set()
@@ -0,0 +1,188 @@
+import inspect
+import itertools
+import random
+import threading
+import unittest
+
+import client
+import localserver
+from dnscore.protocol import SERVFAIL
+from localserver import LocalDNSServer, PendingQuery, PendingTable
+
+UPSTREAM = ("127.0.0.1", localserver.AMAZON_ADDR[1])
+
+
+class RotatingRandom(random.Random):
+    # picks each upstream socket in turn, so two picks in a row never land on the same one
+    def __init__(self):
+        super().__init__(0)
+        self.picks = itertools.count()
+
+    def randrange(self, n):
+        return next(self.picks) % n
+
+
+class RecordingServer(LocalDNSServer):
+    # a LocalDNSServer on ephemeral ports whose datagrams are recorded instead of sent
+    def __init__(self, **kwargs):
+        self.sent = []
+        super().__init__(log_mode="off", **kwargs)
+        self.rng = RotatingRandom()
+
+    def _sendto(self, wire, addr, via=None):
+        self.sent.append((localserver.deserialize(wire), addr, via))
+
+    def close(self):
+        self.tcp_workers.shutdown()
+        self.tcp_listener.close()
+        self.conn.close()
+        for conn in self.upstreams: conn.close()
+
+
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        bind, localserver.LOCAL_BIND = localserver.LOCAL_BIND, ("127.0.0.1", 0)
+        try:
+            self.server = RecordingServer()
+        finally:
+            localserver.LOCAL_BIND = bind
+        self.addCleanup(self.server.close)
+
+    def ask(self, name, rtype="A", txid=1, client=("127.0.0.1", 5353)):
+        self.server._dispatch(localserver.serialize({"txid": txid, "flag": "0000", "question": {"name": name, "type": rtype}}),
+                              client)
+
+    def upstream_queries(self):
+        return [(msg, via) for msg, addr, via in self.server.sent if addr == UPSTREAM]
+
+    def answers(self):
+        return [msg for msg, addr, via in self.server.sent if addr != UPSTREAM]
+
+    def reply(self, msg, via, name="shop.amazone.com", rtype="A", result="3.33.147.88", addr=UPSTREAM):
+        self.server._dispatch(localserver.serialize({"txid": msg["txid"], "flag": "0001",
+                                                     "answer": {"name": name, "type": rtype, "ttl": 60, "result": result}}),
+                              addr, via)
+
+    def retransmit(self, after):
+        pending = self.server.pending
+        self.server._on_pending_due(*pending.expire(pending.next_deadline() + after))
+
+
+class PendingTableTest(unittest.TestCase):
+    def test_join_coalesces_into_the_query_in_flight(self):
+        table = PendingTable()
+        entry = PendingQuery("shop.amazone.com", "A", "first")
+        self.assertFalse(table.join(entry.key, ("second", ())))
+        table.add(7, entry)
+        self.assertTrue(table.join(entry.key, ("second", ())))
+        self.assertEqual(entry.waiters, [("first", ()), ("second", ())])
+        self.assertEqual(table.stats["coalesced"], 1)
+
+    def test_expire_retransmits_with_backoff_then_fails(self):
+        table = PendingTable(timeout=1.0, retries=2, backoff=2.0)
+        entry = PendingQuery("shop.amazone.com", "A", "client")
+        table.add(7, entry)
+        start = entry.started
+        self.assertEqual(table.expire(start + 0.9), ([], []))
+        self.assertEqual(table.expire(start + 1.1), ([(7, entry)], []))
+        self.assertEqual(table.expire(start + 2.9), ([], []))
+        self.assertEqual(table.expire(start + 3.2), ([(7, entry)], []))
+        self.assertEqual(table.expire(start + 7.5), ([], [entry]))
+        self.assertNotIn(7, table)
+        self.assertNotIn(entry.key, table.inflight)
+
+    def test_default_attempts_fit_in_the_client_timeout(self):
+        # otherwise the stock client gives up before the SERVFAIL arrives
+        self.assertLess(PendingTable().budget, inspect.signature(client.ResolverBase).parameters["timeout"].default)
+
+    def test_cap_evicts_the_oldest(self):
+        table = PendingTable(max_entries=2)
+        first, second, third = (PendingQuery(f"h{i}.amazone.com", "A", "client") for i in range(3))
+        table.add(1, first)
+        table.add(2, second)
+        self.assertIs(table.add(3, third), first)
+        self.assertEqual(sorted(table.entries), [2, 3])
+        self.assertEqual(table.stats["evictions"], 1)
+
+
+class SpoofCheckTest(ServerTestCase):
+    def test_only_a_matching_reply_is_accepted(self):
+        self.ask("shop.amazone.com")
+        [(query, via)] = self.upstream_queries()
+        other = next(i for i in range(len(self.server.upstreams)) if i != via)
+        self.reply({"txid": query["txid"] ^ 1}, via)
+        self.reply(query, via, addr=("127.0.0.2", UPSTREAM[1]))
+        self.reply(query, other)
+        self.reply(query, via, name="evil.amazone.com")
+        self.assertEqual(self.answers(), [])
+        stats = self.server.stats
+        self.assertEqual((stats["rejected_txid"], stats["rejected_source"], stats["rejected_question"]), (1, 2, 1))
+        self.reply(query, via)
+        [answer] = self.answers()
+        self.assertEqual(answer["answer"]["result"], "3.33.147.88")
+
+    def test_clients_asking_the_same_question_share_one_query(self):
+        self.ask("shop.amazone.com", txid=1)
+        self.ask("shop.amazone.com", txid=2, client=("127.0.0.1", 5354))
+        [(query, via)] = self.upstream_queries()
+        self.reply(query, via)
+        self.assertEqual(sorted(answer["txid"] for answer in self.answers()), [1, 2])
+
+    def test_reply_to_an_earlier_copy_is_accepted_after_a_retransmit(self):
+        self.ask("shop.amazone.com")
+        self.retransmit(0.1)
+        (first, first_via), (again, again_via) = self.upstream_queries()
+        self.assertEqual((again["txid"], again_via), (first["txid"], first_via))
+        self.reply(first, first_via)
+        self.assertEqual(self.server.stats["rejected_source"], 0)
+        [answer] = self.answers()
+        self.assertEqual(answer["answer"]["result"], "3.33.147.88")
+
+    def test_batched_queries_keep_their_socket_when_retransmitted(self):
+        self.server._dispatch(localserver.serialize({"txid": 1, "flag": "0000", "questions": [
+            {"name": "shop.amazone.com", "type": "A"}, {"name": "cloud.amazone.com", "type": "A"}]}), ("127.0.0.1", 5353))
+        [(batch, via)] = self.upstream_queries()
+        self.retransmit(0.1)
+        vias = {v for _, v in self.upstream_queries()}
+        self.assertEqual(vias, {via})
+        for q in batch["questions"]:
+            self.reply(q, via, name=q["name"])
+        [answer] = self.answers()
+        self.assertEqual([a["result"] for a in answer["answers"]], ["3.33.147.88"] * 2)
+
+    def test_truncated_answer_stays_joinable_while_fetched_over_tcp(self):
+        release = threading.Event()
+        def exchange(txid, entry):
+            release.wait(5)
+            return {"txid": txid, "flag": "0001", "answer": {"name": entry.name, "type": entry.rtype, "ttl": 60, "result": "big"}}
+        self.server._exchange_tcp = exchange
+        self.ask("big.amazone.com", txid=1)
+        [(query, via)] = self.upstream_queries()
+        truncated = localserver.serialize({"txid": query["txid"], "flag": "0001", "tc": 1,
+                                           "question": {"name": "big.amazone.com", "type": "A"}})
+        self.server._dispatch(truncated, UPSTREAM, via)
+        self.server._dispatch(truncated, UPSTREAM, via)  # a retransmitted copy's reply
+        self.ask("big.amazone.com", txid=2, client=("127.0.0.1", 5354))
+        self.assertEqual(self.server.pending.expire(float("inf")), ([], []))
+        self.assertEqual((len(self.upstream_queries()), self.server.stats["tcp_retries"]), (1, 1))
+        release.set()
+        self.server.tcp_workers.shutdown()
+        self.assertEqual(sorted((answer["txid"], answer["answer"]["result"]) for answer in self.answers()),
+                         [(1, "big"), (2, "big")])
+        self.assertEqual(len(self.server.pending), 0)
+
+    def test_deeply_nested_datagram_is_a_decode_error(self):
+        self.server._dispatch("[" * 3000, ("127.0.0.1", 5353))
+        self.assertEqual(self.server.stats["decode_errors"], 1)
+        self.assertEqual(self.server.sent, [])
+
+    def test_servfail_once_every_attempt_times_out(self):
+        self.ask("shop.amazone.com")
+        for _ in range(self.server.pending.retries + 1):
+            self.retransmit(0.1)
+        [answer] = self.answers()
+        self.assertEqual(answer["answer"]["result"], SERVFAIL)
+
+
+if __name__ == "__main__":
+    unittest.main()